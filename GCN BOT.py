@@ -1,21 +1,47 @@
 import os
+import sys
 import io
+import copy
 import json
 import re
 import time
 import threading
 import socket
-from typing import Dict, Any, Optional, Tuple, List
+import random
+import hashlib
+import base64
+import binascii
+import sqlite3
+import queue
+import math
+import zlib
+import uuid
+import subprocess
+import signal
+from collections import OrderedDict
+from datetime import datetime, timezone
+from html import escape as html_escape
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Optional, Tuple, List, Set, Callable
 from pathlib import Path
+from urllib.parse import urlparse
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
+from requests.adapters import HTTPAdapter
 from gcn_kafka import Consumer
+from confluent_kafka import TopicPartition
 
 # --- Immagini / grafica ---
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import LogNorm
 from PIL import Image, ImageDraw, ImageFont
 from astropy.io import fits
 
@@ -26,6 +52,12 @@ try:
 except Exception:
     HAVE_HEALPY = False
 
+try:
+    import orjson  # type: ignore
+    HAVE_ORJSON = True
+except Exception:
+    HAVE_ORJSON = False
+
 # ==========================
 # CARTELLA DATI PERSISTENTI (funziona anche da .exe)
 # ==========================
@@ -57,19 +89,31 @@ CLIENT_SECRET = "****************************
 # ==========================
 # TOPICS GCN (validi)
 # ==========================
+# Fermi GBM: VOEvent XML (default) oppure classic text con GCN_BOT_FERMI_FORMAT=text
+FERMI_GBM_FORMAT = "text" if os.getenv("GCN_BOT_FERMI_FORMAT", "voevent").lower() == "text" else "voevent"
+
 TOPICS = [
     "igwn.gwalert",                       # GW JSON
     "gcn.notices.swift.bat.guano",        # Swift GUANO (JSON)
-    "gcn.classic.text.FERMI_GBM_ALERT",   # Fermi GBM classic text
-    "gcn.classic.text.FERMI_GBM_FLT_POS",
-    "gcn.classic.text.FERMI_GBM_GND_POS",
-    "gcn.classic.text.FERMI_GBM_FIN_POS",
+] + [
+    f"gcn.classic.{FERMI_GBM_FORMAT}.FERMI_GBM_{kind}"   # Fermi GBM
+    for kind in ("ALERT", "FLT_POS", "GND_POS", "FIN_POS")
 ]
 
+# ==========================
+# CLUSTER (più processi worker)
+# ==========================
+# Impostati dal launcher (--workers N). Ogni worker consuma dallo stesso gruppo Kafka e
+# consegna solo le chat del proprio shard (|chat_id| % WORKER_COUNT == WORKER_INDEX).
+WORKER_COUNT = max(1, int(os.getenv("GCN_BOT_WORKERS", "1")))
+WORKER_INDEX = int(os.getenv("GCN_BOT_WORKER", "0")) % WORKER_COUNT
+LEADER_LEASE_SEC = 15.0       # il leader (comandi Telegram, circulars) rinnova il lease entro questo tempo
+SUBS_REFRESH_SEC = 2.0        # ogni quanto i worker rileggono gli iscritti modificati
+
 # ==========================
 # STORAGE (dentro DATA_DIR)
 # ==========================
-SEEN_FILE = str(DATA_DIR / "seen_offsets.json")   # {topic: last_offset}
+# File JSON delle versioni precedenti: importati una sola volta nel database (vedi StateStore)
 SUBS_FILE = str(DATA_DIR / "subscribers.json")    # {chat_id: {"filters":{...}, "muted": bool}}
 CIRC_FILE = str(DATA_DIR / "circulars_seen.json") # {"last_id": 12345}
 
@@ -93,35 +137,218 @@ def save_json(path: str, data) -> None:
     except Exception as e:
         print(f"[save_json] warning: {e}")
 
+# ==========================
+# HTTP (sessioni con keep-alive)
+# ==========================
+HTTP_CONNECT_TIMEOUT = 5.0   # secondi per connessione TCP+TLS
+HTTP_TG_POOL_SIZE = 24       # >= FANOUT_WORKERS: una connessione per worker di fan-out
+HTTP_GCN_POOL_SIZE = 8
+HTTP_WEB_POOL_SIZE = 8
+
+class HttpPool:
+    """Sessione `requests` condivisa con pool di connessioni keep-alive e statistiche."""
+
+    def __init__(self, name: str, pool_size: int, read_timeout: float = 30):
+        self.name = name
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_errors = 0
+        self.total_time = 0.0
+
+    def request(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        t0 = time.monotonic()
+        failed = False
+        try:
+            return self.session.request(
+                method, url, timeout=(HTTP_CONNECT_TIMEOUT, timeout or self.read_timeout), **kwargs
+            )
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self.n_requests += 1
+                self.n_errors += failed
+                self.total_time += time.monotonic() - t0
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        connections = 0
+        try:
+            pools = self._adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                connections += pools[key].num_connections
+        except Exception:
+            pass
+        with self._lock:
+            avg_ms = 1000 * self.total_time / self.n_requests if self.n_requests else 0.0
+            return {"requests": self.n_requests, "errors": self.n_errors,
+                    "connections": connections, "avg_ms": avg_ms}
+
+HTTP_TG = HttpPool("telegram", HTTP_TG_POOL_SIZE, read_timeout=20)
+HTTP_GCN = HttpPool("gcn", HTTP_GCN_POOL_SIZE, read_timeout=30)
+HTTP_WEB = HttpPool("web", HTTP_WEB_POOL_SIZE, read_timeout=30)
+
+def http_for(url: str) -> HttpPool:
+    """Pool dedicato a gcn.nasa.gov; gli altri host (GraceDB, immagini) usano il pool generico."""
+    host = urlparse(url).hostname or ""
+    if host == "gcn.nasa.gov" or host.endswith(".gcn.nasa.gov"):
+        return HTTP_GCN
+    return HTTP_WEB
+
+def http_pool_stats() -> Dict[str, Dict[str, Any]]:
+    return {p.name: p.stats() for p in (HTTP_TG, HTTP_GCN, HTTP_WEB)}
+
 # ==========================
 # TELEGRAM API
 # ==========================
 TG = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 
+class TelegramError(Exception):
+    """Risposta non-ok della Bot API (con eventuale retry_after per i 429)."""
+
+    def __init__(self, description: str, error_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.retry_after = retry_after
+
+def tg_call(method: str, payload: Optional[dict] = None, data: Optional[dict] = None,
+            files: Optional[dict] = None, timeout: float = 20) -> Any:
+    """Chiama un metodo della Bot API e restituisce `result`; solleva TelegramError se ok=false."""
+    if files is not None or data is not None:
+        r = HTTP_TG.post(f"{TG}/{method}", data=data, files=files, timeout=timeout)
+    else:
+        r = HTTP_TG.post(f"{TG}/{method}", json=payload, timeout=timeout)
+    try:
+        body = r.json()
+    except ValueError:
+        body = {}
+    if r.status_code == 200 and body.get("ok"):
+        return body.get("result")
+    params = body.get("parameters") or {}
+    raise TelegramError(
+        body.get("description") or f"HTTP {r.status_code}",
+        error_code=body.get("error_code") or r.status_code,
+        retry_after=params.get("retry_after"),
+    )
+
+def _send_text(chat_id: int, text: str, parse_mode: Optional[str] = "HTML", reply_markup: Optional[dict] = None):
+    payload = {
+        "chat_id": chat_id,
+        "text": text[:4000],
+        "parse_mode": parse_mode,
+        "disable_web_page_preview": True
+    }
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    return tg_call("sendMessage", payload, timeout=20)
+
+def _send_photo_bytes(chat_id: int, img_bytes: bytes, caption: Optional[str] = None):
+    files = {"photo": ("image.jpg", img_bytes, "image/jpeg")}
+    data = {"chat_id": str(chat_id)}
+    if caption:
+        data["caption"] = caption[:1024]
+        data["parse_mode"] = "HTML"
+    return tg_call("sendPhoto", data=data, files=files, timeout=60)
+
+def _send_photo_file_id(chat_id: int, file_id: str, caption: Optional[str] = None):
+    payload = {"chat_id": chat_id, "photo": file_id}
+    if caption:
+        payload["caption"] = caption[:1024]
+        payload["parse_mode"] = "HTML"
+    return tg_call("sendPhoto", payload, timeout=20)
+
+def _edit_photo_media(chat_id: int, message_id: int, file_id: Optional[str], img_bytes: Optional[bytes],
+                      caption: Optional[str] = None):
+    """Sostituisce la foto di un messaggio già inviato (per file_id oppure caricando i byte)."""
+    media = {"type": "photo", "media": file_id or "attach://photo"}
+    if caption:
+        media["caption"] = caption[:1024]
+        media["parse_mode"] = "HTML"
+    if file_id:
+        return tg_call("editMessageMedia", {"chat_id": chat_id, "message_id": message_id, "media": media}, timeout=20)
+    data = {"chat_id": str(chat_id), "message_id": str(message_id), "media": json.dumps(media)}
+    return tg_call("editMessageMedia", data=data, files={"photo": ("image.jpg", img_bytes, "image/jpeg")}, timeout=60)
+
+def _edit_caption(chat_id: int, message_id: int, caption: Optional[str]):
+    payload = {"chat_id": chat_id, "message_id": message_id, "caption": (caption or "")[:1024], "parse_mode": "HTML"}
+    return tg_call("editMessageCaption", payload, timeout=20)
+
+def _photo_file_id(message: Optional[dict]) -> Optional[str]:
+    photos = (message or {}).get("photo") or []
+    return photos[-1].get("file_id") if photos else None
+
+class PhotoUpload:
+    """Foto destinata a molte chat: i byte si caricano una volta, poi si riusa il file_id."""
+
+    def __init__(self, img_bytes: bytes, caption: Optional[str] = None):
+        self.img_bytes = img_bytes
+        self.caption = caption
+        self.file_id: Optional[str] = None
+        self.uploads = 0
+        self._lock = threading.Lock()
+
+    def send(self, chat_id: int):
+        file_id = self.file_id
+        if file_id:
+            try:
+                return _send_photo_file_id(chat_id, file_id, self.caption)
+            except TelegramError as e:
+                desc = str(e).lower()
+                if e.error_code != 400 or not ("file" in desc or "photo" in desc):
+                    raise
+                print(f"[Telegram] file_id rifiutato ({e}), nuovo upload")
+                with self._lock:
+                    if self.file_id == file_id:
+                        self.file_id = None
+        msg = _send_photo_bytes(chat_id, self.img_bytes, caption=self.caption)
+        with self._lock:
+            self.uploads += 1
+            if self.file_id is None:
+                self.file_id = _photo_file_id(msg)
+        return msg
+
+    def edit(self, chat_id: int, message_id: int, caption_only: bool = False):
+        """Aggiorna un messaggio già inviato; con `caption_only` cambia solo la didascalia."""
+        if caption_only:
+            return _edit_caption(chat_id, message_id, self.caption)
+        file_id = self.file_id
+        if file_id:
+            try:
+                return _edit_photo_media(chat_id, message_id, file_id, None, self.caption)
+            except TelegramError as e:
+                desc = str(e).lower()
+                if e.error_code != 400 or "not modified" in desc or not ("file" in desc or "photo" in desc):
+                    raise
+                with self._lock:
+                    if self.file_id == file_id:
+                        self.file_id = None
+        msg = _edit_photo_media(chat_id, message_id, None, self.img_bytes, self.caption)
+        with self._lock:
+            self.uploads += 1
+            if self.file_id is None and isinstance(msg, dict):
+                self.file_id = _photo_file_id(msg)
+        return msg
+
 def tg_send_text(chat_id: int, text: str, parse_mode: Optional[str] = "HTML", reply_markup: Optional[dict] = None):
     try:
-        payload = {
-            "chat_id": chat_id,
-            "text": text[:4000],
-            "parse_mode": parse_mode,
-            "disable_web_page_preview": True
-        }
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        r = requests.post(f"{TG}/sendMessage", json=payload, timeout=20)
-        r.raise_for_status()
+        _send_text(chat_id, text, parse_mode=parse_mode, reply_markup=reply_markup)
     except Exception as e:
         print(f"[Telegram] send_text error: {e}")
 
 def tg_send_photo_bytes(chat_id: int, img_bytes: bytes, caption: Optional[str] = None):
     try:
-        files = {"photo": ("image.jpg", img_bytes, "image/jpeg")}
-        data = {"chat_id": str(chat_id)}
-        if caption:
-            data["caption"] = caption[:1024]
-            data["parse_mode"] = "HTML"
-        r = requests.post(f"{TG}/sendPhoto", data=data, files=files, timeout=60)
-        r.raise_for_status()
+        _send_photo_bytes(chat_id, img_bytes, caption=caption)
     except Exception as e:
         print(f"[Telegram] send_photo error: {e}")
 
@@ -130,7 +357,7 @@ def tg_get_updates(offset: Optional[int] = None, timeout=30):
         params = {"timeout": timeout}
         if offset is not None:
             params["offset"] = offset
-        r = requests.get(f"{TG}/getUpdates", params=params, timeout=timeout+5)
+        r = HTTP_TG.get(f"{TG}/getUpdates", params=params, timeout=timeout+5)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -139,7 +366,7 @@ def tg_get_updates(offset: Optional[int] = None, timeout=30):
 
 def tg_answer_callback_query(cb_id: str, text: str = ""):
     try:
-        requests.post(f"{TG}/answerCallbackQuery", json={"callback_query_id": cb_id, "text": text[:200]}, timeout=10)
+        HTTP_TG.post(f"{TG}/answerCallbackQuery", json={"callback_query_id": cb_id, "text": text[:200]}, timeout=10)
     except Exception:
         pass
 
@@ -148,33 +375,751 @@ def tg_edit_message_text(chat_id: int, message_id: int, text: str, reply_markup:
         payload = {"chat_id": chat_id, "message_id": message_id, "text": text[:4000], "parse_mode": "HTML", "disable_web_page_preview": True}
         if reply_markup:
             payload["reply_markup"] = reply_markup
-        requests.post(f"{TG}/editMessageText", json=payload, timeout=15)
+        HTTP_TG.post(f"{TG}/editMessageText", json=payload, timeout=15)
     except Exception:
         pass
 
 def tg_set_my_commands(commands: List[Tuple[str, str]]):
     try:
         cmd_list = [{"command": c, "description": d[:256]} for c, d in commands]
-        requests.post(f"{TG}/setMyCommands", json={"commands": cmd_list}, timeout=10)
+        HTTP_TG.post(f"{TG}/setMyCommands", json={"commands": cmd_list}, timeout=10)
     except Exception:
         pass
 
+def tg_set_webhook(url: str, secret_token: str) -> bool:
+    """Registra il webhook: Telegram invierà gli update a `url` con l'header del segreto."""
+    try:
+        tg_call("setWebhook", {
+            "url": url,
+            "secret_token": secret_token,
+            "max_connections": 1,   # una connessione: Telegram consegna gli update in ordine
+            "allowed_updates": ["message", "edited_message", "callback_query"],
+        }, timeout=10)
+        return True
+    except Exception as e:
+        print(f"[Telegram] setWebhook error: {e}")
+        return False
+
 def tg_delete_webhook():
     """Disattiva il webhook così getUpdates funziona senza 409."""
     try:
-        requests.post(f"{TG}/deleteWebhook", json={"drop_pending_updates": False}, timeout=10)
+        HTTP_TG.post(f"{TG}/deleteWebhook", json={"drop_pending_updates": False}, timeout=10)
     except Exception as e:
         print(f"[Telegram] deleteWebhook error: {e}")
 
 def tg_set_my_description(description: str, short_description: Optional[str] = None):
     """Imposta testo visibile nella chat prima di /start (banner del bot)."""
     try:
-        requests.post(f"{TG}/setMyDescription", json={"description": description[:512]}, timeout=10)
+        HTTP_TG.post(f"{TG}/setMyDescription", json={"description": description[:512]}, timeout=10)
         if short_description:
-            requests.post(f"{TG}/setMyShortDescription", json={"short_description": short_description[:120]}, timeout=10)
+            HTTP_TG.post(f"{TG}/setMyShortDescription", json={"short_description": short_description[:120]}, timeout=10)
     except Exception as e:
         print(f"[Telegram] setMyDescription error: {e}")
 
+# ==========================
+# FAN-OUT TELEGRAM (invii concorrenti con rate limit)
+# ==========================
+# msg/s complessivi del bot (limite Telegram ~30/s), divisi fra i worker del cluster
+TG_GLOBAL_RATE = float(os.getenv("GCN_BOT_TG_RATE", "30")) / WORKER_COUNT
+TG_PER_CHAT_RATE = 1.0    # msg/s verso la stessa chat
+FANOUT_WORKERS = 16
+FANOUT_MAX_RETRIES = 3
+
+class TokenBucket:
+    """Token bucket thread-safe: `acquire()` blocca finché non c'è un token."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Blocca il bucket (es. `retry_after` di un 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._tokens >= self.capacity and now >= self._paused_until
+
+class TelegramFanout:
+    """Invia lo stesso messaggio a molte chat in parallelo rispettando i limiti Telegram."""
+
+    def __init__(self, workers: int = FANOUT_WORKERS, global_rate: float = TG_GLOBAL_RATE,
+                 per_chat_rate: float = TG_PER_CHAT_RATE):
+        self.workers = workers
+        self.per_chat_rate = per_chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self.last_broadcast: Optional[Tuple[str, int, int, float]] = None
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fanout")
+            return self._pool
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self._chat_buckets) > 10000:
+                    # scarta i bucket inattivi per non crescere all'infinito
+                    self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.idle()}
+                bucket = TokenBucket(self.per_chat_rate, capacity=1)
+                self._chat_buckets[chat_id] = bucket
+            return bucket
+
+    def deliver(self, chat_id: int, send: Callable[[int], Any]) -> Optional[Exception]:
+        """Invio singolo con rate limit; ritenta sui 429 e sugli errori di rete.
+
+        Restituisce None se consegnato, altrimenti l'ultimo errore.
+        """
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(FANOUT_MAX_RETRIES + 1):
+            bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                send(chat_id)
+                return None
+            except TelegramError as e:
+                if e.retry_after and attempt < FANOUT_MAX_RETRIES:
+                    bucket.pause(float(e.retry_after))
+                    self.global_bucket.pause(float(e.retry_after))
+                    continue
+                return e
+            except Exception as e:
+                if attempt < FANOUT_MAX_RETRIES:
+                    time.sleep(2 ** attempt)
+                    continue
+                return e
+        return None
+
+    def broadcast(self, chat_ids: List[int], send: Callable[[int], Any], label: str = "",
+                  ready: Optional[Callable[[], bool]] = None) -> Dict[int, Optional[Exception]]:
+        """Invia a tutte le chat e restituisce {chat_id: errore o None}.
+
+        Se `ready` è indicato, le chat vengono servite una alla volta finché
+        `ready()` non diventa vero; le rimanenti partono poi in parallelo.
+        """
+        t0 = time.monotonic()
+        results: Dict[int, Optional[Exception]] = {}
+        i = 0
+        if ready is not None:
+            while i < len(chat_ids) and not ready():
+                results[chat_ids[i]] = self.deliver(chat_ids[i], send)
+                i += 1
+        pool = self._executor()
+        futures = {cid: pool.submit(self.deliver, cid, send) for cid in chat_ids[i:]}
+        for cid, fut in futures.items():
+            results[cid] = fut.result()
+        elapsed = time.monotonic() - t0
+        if chat_ids:
+            ok = sum(1 for err in results.values() if err is None)
+            self.last_broadcast = (label or "invio", ok, len(chat_ids), elapsed)
+            print(f"[broadcast] {label or 'invio'}: {ok}/{len(chat_ids)} chat in {elapsed:.2f}s")
+        return results
+
+    def broadcast_photo(self, chat_ids: List[int], photo: "PhotoUpload",
+                        label: str = "") -> Dict[int, Optional[Exception]]:
+        """Come `broadcast`, ma la foto viene caricata una volta e poi inviata per file_id."""
+        results = self.broadcast(chat_ids, photo.send, label=label, ready=lambda: photo.file_id is not None)
+        if chat_ids:
+            print(f"[broadcast] {label or 'invio'}: {photo.uploads} upload per {len(chat_ids)} chat")
+        return results
+
+FANOUT = TelegramFanout()
+
+# ==========================
+# OUTBOX PERSISTENTE (SQLite)
+# ==========================
+DB_FILE = str(DATA_DIR / "gcn_bot.sqlite3")
+OUTBOX_BATCH = 1000           # job estratti per giro
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_BACKOFF_BASE = 5.0     # secondi, raddoppia a ogni tentativo
+OUTBOX_BACKOFF_MAX = 900.0
+OUTBOX_LEASE_SEC = 300        # un job "in consegna" torna disponibile dopo un crash
+OUTBOX_EDIT_TTL = 2 * 86400   # per quanto si ricordano i messaggi inviati per evento (per le modifiche)
+OUTBOX_POLL_SEC = 5.0 if WORKER_COUNT == 1 else 0.5   # in cluster i job arrivano anche da altri processi
+
+def db_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def _is_permanent_error(err: Exception) -> bool:
+    """Chat inesistente, bot bloccato, richiesta malformata: inutile ritentare."""
+    return isinstance(err, TelegramError) and err.error_code in (400, 403) and not err.retry_after
+
+class Outbox:
+    """Coda persistente dei messaggi da consegnare.
+
+    Ogni job è una coppia (chat_id, payload). Le immagini sono salvate una
+    sola volta in `outbox_media` e referenziate dai job. Un thread di consegna
+    estrae i job scaduti, li invia tramite FANOUT e ripianifica quelli falliti
+    con backoff esponenziale e jitter; i job sopravvivono ai riavvii.
+
+    I job con `event_key` aggiornano lo stesso evento: un nuovo job sostituisce
+    quelli non ancora partiti, e le chat che hanno già ricevuto il messaggio
+    (tabella `outbox_sent`) ricevono una modifica invece di una nuova foto.
+    Ogni job porta l'`event_rank` dell'evento: un aggiornamento di rango
+    inferiore a quello già in coda o già inviato viene ignorato (in cluster
+    può arrivare da un altro worker dopo uno più recente).
+
+    In cluster la coda è condivisa: ogni worker estrae solo i job delle chat
+    del proprio shard.
+    """
+
+    def __init__(self, fanout: TelegramFanout):
+        self.fanout = fanout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self.delivered = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # chiamato sempre con il lock acquisito
+        if self._conn is None:
+            self._conn = db_connect()
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox_media (
+                    hash TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    file_id TEXT
+                );
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    method TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    media TEXT,
+                    label TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_at REAL NOT NULL,
+                    claimed REAL,
+                    created REAL NOT NULL,
+                    last_error TEXT
+                );
+                CREATE INDEX IF NOT EXISTS outbox_due ON outbox(next_at);
+                CREATE INDEX IF NOT EXISTS outbox_media_ref ON outbox(media);
+                CREATE TABLE IF NOT EXISTS outbox_sent (
+                    event_key TEXT NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    media TEXT,
+                    sent REAL NOT NULL,
+                    PRIMARY KEY (event_key, chat_id)
+                );
+            """)
+            cols = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+            if "event_key" not in cols:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN event_key TEXT")
+            if "event_rank" not in cols:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN event_rank INTEGER")
+            if "event_rank" not in {row[1] for row in self._conn.execute("PRAGMA table_info(outbox_sent)")}:
+                self._conn.execute("ALTER TABLE outbox_sent ADD COLUMN event_rank INTEGER")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_event ON outbox(event_key)")
+            self._conn.commit()
+        return self._conn
+
+    def _enqueue(self, chat_ids: List[int], method: str, payload: Dict[str, Any],
+                 media: Optional[str], label: str, event_key: Optional[str] = None,
+                 media_data: Optional[bytes] = None, event_rank: int = 0) -> None:
+        if not chat_ids:
+            return
+        now = time.time()
+        body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        with self._lock:
+            db = self._db()
+            with db:
+                if event_key:
+                    # lock di scrittura subito: controllo del rango e inserimento atomici fra i worker
+                    db.execute("BEGIN IMMEDIATE")
+                    row = db.execute(
+                        "SELECT MAX(event_rank) FROM (SELECT event_rank FROM outbox WHERE event_key = ? "
+                        "UNION ALL SELECT event_rank FROM outbox_sent WHERE event_key = ?)",
+                        (event_key, event_key),
+                    ).fetchone()
+                    if row and row[0] is not None and event_rank < row[0]:
+                        print(f"[Outbox] {event_key}: aggiornamento di rango {event_rank} < {row[0]} ignorato")
+                        return
+                if media_data is not None:
+                    # stessa transazione dei job: la pulizia di un altro worker non può rimuoverla prima
+                    db.execute("INSERT OR IGNORE INTO outbox_media (hash, data) VALUES (?, ?)",
+                               (media, sqlite3.Binary(media_data)))
+                if event_key:
+                    # versione più recente dello stesso evento: i job non ancora partiti sono superati
+                    db.execute("DELETE FROM outbox WHERE event_key = ? AND claimed IS NULL", (event_key,))
+                db.executemany(
+                    "INSERT INTO outbox (chat_id, method, payload, media, label, next_at, created, event_key, "
+                    "event_rank) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(cid, method, body, media, label, now, now, event_key, event_rank) for cid in chat_ids],
+                )
+        self._wake.set()
+
+    def enqueue_text(self, chat_ids: List[int], text: str, label: str = "") -> None:
+        self._enqueue(chat_ids, "sendMessage", {"text": text}, None, label)
+
+    def enqueue_photo(self, chat_ids: List[int], img_bytes: bytes, caption: Optional[str] = None,
+                      label: str = "", event_key: Optional[str] = None, event_rank: int = 0) -> None:
+        if not chat_ids:
+            return
+        digest = hashlib.sha256(img_bytes).hexdigest()
+        self._enqueue(chat_ids, "sendPhoto", {"caption": caption}, digest, label, event_key, img_bytes,
+                      event_rank)
+
+    def _claim(self) -> List[tuple]:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                rows = db.execute(
+                    "SELECT id, chat_id, method, payload, media, label, attempts, event_key, event_rank FROM outbox "
+                    "WHERE next_at <= ? AND (claimed IS NULL OR claimed < ?) AND abs(chat_id) % ? = ? "
+                    "ORDER BY id LIMIT ?",
+                    (now, now - OUTBOX_LEASE_SEC, WORKER_COUNT, WORKER_INDEX, OUTBOX_BATCH),
+                ).fetchall()
+                db.executemany("UPDATE outbox SET claimed = ? WHERE id = ?", [(now, r[0]) for r in rows])
+        return rows
+
+    def _next_due(self) -> Optional[float]:
+        with self._lock:
+            row = self._db().execute("SELECT MIN(next_at) FROM outbox WHERE claimed IS NULL "
+                                     "AND abs(chat_id) % ? = ?", (WORKER_COUNT, WORKER_INDEX)).fetchone()
+        return row[0] if row else None
+
+    def _media(self, digest: str) -> Tuple[Optional[bytes], Optional[str]]:
+        with self._lock:
+            row = self._db().execute("SELECT data, file_id FROM outbox_media WHERE hash = ?", (digest,)).fetchone()
+        return (bytes(row[0]), row[1]) if row else (None, None)
+
+    def _sent_messages(self, event_key: str,
+                       chat_ids: List[int]) -> Dict[int, Tuple[int, Optional[str], Optional[int]]]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT chat_id, message_id, media, event_rank FROM outbox_sent WHERE event_key = ?", (event_key,)
+            ).fetchall()
+        wanted = set(chat_ids)
+        return {cid: (mid, media, rank) for cid, mid, media, rank in rows if cid in wanted}
+
+    def _record_sent(self, event_key: str, media: Optional[str], sent: Dict[int, int], event_rank: int) -> None:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM outbox_sent WHERE sent < ?", (now - OUTBOX_EDIT_TTL,))
+                db.executemany(
+                    "INSERT OR REPLACE INTO outbox_sent (event_key, chat_id, message_id, media, sent, event_rank) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(event_key, cid, mid, media, now, event_rank) for cid, mid in sent.items()],
+                )
+
+    def _send_event_photo(self, photo: PhotoUpload, media: Optional[str], label: str, chat_ids: List[int],
+                          event_key: str, event_rank: int = 0) -> Dict[int, Optional[Exception]]:
+        """Prima consegna di un evento: foto nuova; consegne successive: modifica del messaggio."""
+        prior = self._sent_messages(event_key, chat_ids)
+        # chat che hanno già una versione più recente: nessuna modifica all'indietro
+        stale = {cid for cid, prev in prior.items() if prev[2] is not None and event_rank < prev[2]}
+        chat_ids = [cid for cid in chat_ids if cid not in stale]
+        sent: Dict[int, int] = {}
+
+        def send(cid: int):
+            prev = prior.get(cid)
+            msg = None
+            if prev is not None:
+                try:
+                    msg = photo.edit(cid, prev[0], caption_only=(prev[1] == media))
+                except TelegramError as e:
+                    desc = str(e).lower()
+                    if e.error_code != 400:
+                        raise
+                    if "not modified" in desc:
+                        return None
+                    if "not found" not in desc and "can't be edited" not in desc:
+                        raise
+                    msg = None   # messaggio cancellato: se ne invia uno nuovo
+            if msg is None:
+                msg = photo.send(cid)
+            if isinstance(msg, dict) and msg.get("message_id"):
+                sent[cid] = msg["message_id"]
+            return msg
+
+        needs_upload = any(prior.get(cid) is None or prior[cid][1] != media for cid in chat_ids)
+        results = self.fanout.broadcast(chat_ids, send, label=label,
+                                        ready=lambda: not needs_upload or photo.file_id is not None)
+        if sent:
+            self._record_sent(event_key, media, sent, event_rank)
+        results.update({cid: None for cid in stale})
+        return results
+
+    def _send_group(self, method: str, payload: Dict[str, Any], media: Optional[str],
+                    label: str, chat_ids: List[int], event_key: Optional[str] = None,
+                    event_rank: int = 0) -> Dict[int, Optional[Exception]]:
+        if method == "sendPhoto":
+            data, file_id = self._media(media or "")
+            if data is None:
+                return {cid: TelegramError("immagine mancante nell'outbox", 400) for cid in chat_ids}
+            photo = PhotoUpload(data, payload.get("caption"))
+            photo.file_id = file_id
+            if event_key:
+                results = self._send_event_photo(photo, media, label, chat_ids, event_key, event_rank)
+            else:
+                results = self.fanout.broadcast_photo(chat_ids, photo, label=label)
+            if photo.file_id and photo.file_id != file_id:
+                with self._lock:
+                    db = self._db()
+                    with db:
+                        db.execute("UPDATE outbox_media SET file_id = ? WHERE hash = ?", (photo.file_id, media))
+            return results
+        text = payload.get("text") or ""
+        return self.fanout.broadcast(chat_ids, lambda cid: _send_text(cid, text), label=label)
+
+    def _settle(self, jobs: List[tuple], results: Dict[int, Optional[Exception]]) -> None:
+        now = time.time()
+        done, retry = [], []
+        for job_id, chat_id, attempts in jobs:
+            err = results.get(chat_id)
+            if err is None:
+                done.append((job_id,))
+                self.delivered += 1
+            elif _is_permanent_error(err) or attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                print(f"[Outbox] chat {chat_id}: consegna abbandonata dopo {attempts + 1} tentativi ({err})")
+                done.append((job_id,))
+                self.dropped += 1
+            else:
+                delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** attempts)
+                delay *= random.uniform(0.5, 1.5)
+                retry.append((now + delay, str(err)[:300], job_id))
+                self.retried += 1
+        with self._lock:
+            db = self._db()
+            with db:
+                db.executemany("DELETE FROM outbox WHERE id = ?", done)
+                db.executemany(
+                    "UPDATE outbox SET attempts = attempts + 1, next_at = ?, claimed = NULL, last_error = ? "
+                    "WHERE id = ?", retry,
+                )
+                db.execute("DELETE FROM outbox_media WHERE hash NOT IN "
+                           "(SELECT DISTINCT media FROM outbox WHERE media IS NOT NULL)")
+        if retry:
+            print(f"[Outbox] {len(retry)} consegne ripianificate")
+
+    def process_due(self) -> int:
+        """Consegna i job scaduti; restituisce quanti ne ha gestiti."""
+        rows = self._claim()
+        groups: Dict[Tuple[str, str, Optional[str], Optional[str], int], List[tuple]] = {}
+        labels: Dict[Tuple[str, str, Optional[str], Optional[str], int], str] = {}
+        for job_id, chat_id, method, payload, media, label, attempts, event_key, event_rank in rows:
+            key = (method, payload, media, event_key, event_rank or 0)
+            groups.setdefault(key, []).append((job_id, chat_id, attempts))
+            labels.setdefault(key, label or "")
+        for key, jobs in groups.items():
+            method, payload, media, event_key, event_rank = key
+            t0 = time.monotonic()
+            try:
+                results = self._send_group(method, json.loads(payload), media, labels[key],
+                                           [j[1] for j in jobs], event_key, event_rank)
+            except Exception as e:
+                results = {j[1]: e for j in jobs}
+            self._settle(jobs, results)
+            STORE.log_delivery(labels[key], sum(1 for err in results.values() if err is None), len(jobs),
+                               time.monotonic() - t0)
+        return len(rows)
+
+    def _worker_loop(self) -> None:
+        while True:
+            try:
+                if self.process_due():
+                    continue
+                due = self._next_due()
+                wait = OUTBOX_POLL_SEC if due is None else min(OUTBOX_POLL_SEC, max(0.0, due - time.time()))
+            except Exception as e:
+                print(f"[Outbox] errore: {e}")
+                wait = 5.0
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def start(self) -> None:
+        with self._lock:
+            db = self._db()
+            with db:
+                # uno shard ha un solo processo: i suoi job rimasti "in consegna" erano dell'istanza precedente
+                db.execute("UPDATE outbox SET claimed = NULL WHERE abs(chat_id) % ? = ?",
+                           (WORKER_COUNT, WORKER_INDEX))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._worker_loop, name="outbox", daemon=True)
+                self._worker.start()
+        self._wake.set()
+
+OUTBOX = Outbox(FANOUT)
+
+# ==========================
+# STATO PERSISTENTE (SQLite)
+# ==========================
+STORE_COMMIT_DELAY = 0.2      # secondi: le scritture ravvicinate finiscono nello stesso commit
+STORE_COMMIT_BATCH = 500      # ...ma non più di tante righe per commit
+DELIVERY_LOG_DAYS = 30
+
+class StateStore:
+    """Stato del bot in DB_FILE: iscritti, chiavi/valori (es. ultima circular), log consegne.
+
+    Ogni modifica è un upsert di una sola riga, eseguito subito sulla
+    connessione condivisa (letture coerenti con le proprie scritture); i
+    commit sono raggruppati da un thread di background. Al primo avvio i
+    vecchi file JSON vengono importati.
+    """
+
+    def __init__(self):
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._wake = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+
+    def _db(self) -> sqlite3.Connection:
+        # chiamato sempre con il lock acquisito
+        if self._conn is None:
+            self._conn = db_connect()
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS subscribers (
+                    chat_id INTEGER PRIMARY KEY,
+                    filters TEXT NOT NULL,
+                    muted INTEGER NOT NULL DEFAULT 0,
+                    sky TEXT,
+                    updated REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS kv (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS delivery_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    label TEXT,
+                    ok INTEGER NOT NULL,
+                    total INTEGER NOT NULL,
+                    elapsed REAL
+                );
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    topic TEXT NOT NULL,
+                    partition INTEGER NOT NULL,
+                    "offset" INTEGER NOT NULL,
+                    stage TEXT,
+                    error TEXT,
+                    value BLOB
+                );
+            """)
+            self._import_json_once()
+        return self._conn
+
+    def _write(self, sql: str, args: Tuple = ()) -> None:
+        with self._lock:
+            self._db().execute(sql, args)
+            self._pending += 1
+            if self._pending >= STORE_COMMIT_BATCH:
+                self._commit()
+        self._wake.set()
+
+    def _commit(self) -> None:
+        # chiamato sempre con il lock acquisito
+        if self._conn is not None and self._pending:
+            self._conn.commit()
+            self._pending = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def _writer_loop(self) -> None:
+        while True:
+            self._wake.wait()
+            time.sleep(STORE_COMMIT_DELAY)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[Store] errore commit: {e}")
+
+    def start(self) -> None:
+        with self._lock:
+            self._db()
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="store-writer", daemon=True)
+                self._writer.start()
+
+    def _import_json_once(self) -> None:
+        # chiamato sempre con il lock acquisito, a connessione appena aperta
+        db = self._conn
+        if db.execute("SELECT 1 FROM kv WHERE key = 'json_imported'").fetchone():
+            return
+        subs = load_json(SUBS_FILE, {})
+        circ = load_json(CIRC_FILE, {})
+        now = time.time()
+        with db:
+            for k, v in (subs.items() if isinstance(subs, dict) else []):
+                entry = _normalize_entry(v if isinstance(v, dict) else None)
+                db.execute(
+                    "INSERT OR REPLACE INTO subscribers (chat_id, filters, muted, sky, updated) VALUES (?, ?, ?, ?, ?)",
+                    (int(k), json.dumps(entry["filters"]), int(bool(entry.get("muted"))),
+                     json.dumps(entry["sky"]) if entry.get("sky") else None, now),
+                )
+            if isinstance(circ, dict) and circ.get("last_id"):
+                db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('circulars_last_id', ?)",
+                           (json.dumps(int(circ["last_id"])),))
+            db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('json_imported', ?)", (json.dumps(now),))
+        if subs or circ:
+            print(f"[Store] importati {len(subs) if isinstance(subs, dict) else 0} iscritti e lo stato dai file JSON")
+
+    # ---- iscritti
+    def load_subscribers(self, since: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """Tutti gli iscritti, oppure (con `since`) solo quelli modificati dopo quell'istante."""
+        with self._lock:
+            rows = self._db().execute("SELECT chat_id, filters, muted, sky FROM subscribers WHERE updated > ?",
+                                      (-1.0 if since is None else since,)).fetchall()
+        out = {}
+        for chat_id, filters, muted, sky in rows:
+            entry = {"filters": json.loads(filters), "muted": bool(muted)}
+            if sky:
+                entry["sky"] = json.loads(sky)
+            out[str(chat_id)] = entry
+        return out
+
+    def upsert_subscriber(self, chat_id: int, entry: Dict[str, Any]) -> None:
+        self._write(
+            "INSERT INTO subscribers (chat_id, filters, muted, sky, updated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET filters = excluded.filters, muted = excluded.muted, "
+            "sky = excluded.sky, updated = excluded.updated",
+            (chat_id, json.dumps(entry.get("filters") or {}), int(bool(entry.get("muted"))),
+             json.dumps(entry["sky"]) if entry.get("sky") else None, time.time()),
+        )
+
+    # ---- chiavi/valori
+    def get_kv(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._db().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_kv(self, key: str, value: Any) -> None:
+        self._write("INSERT INTO kv (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+
+    def try_lease(self, key: str, owner: str, ttl: float) -> bool:
+        """Acquisisce o rinnova il lease `key` per `owner` se è libero, scaduto o già suo (commit immediato)."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value "
+                "WHERE json_extract(kv.value, '$.owner') = ? OR json_extract(kv.value, '$.expires') < ?",
+                (key, json.dumps({"owner": owner, "expires": now + ttl}), owner, now),
+            )
+            db.commit()
+            self._pending = 0
+            row = db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return bool(row) and json.loads(row[0]).get("owner") == owner
+
+    # ---- messaggi Kafka non elaborabili
+    def dead_letter(self, topic: str, partition: int, offset: int, value: bytes, stage: str, error: str) -> None:
+        """Salva il messaggio originale (commit immediato): solo dopo il suo offset può essere confermato."""
+        self._write('INSERT INTO dead_letters (ts, topic, partition, "offset", stage, error, value) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (time.time(), topic, partition, offset, stage, error[:1000], sqlite3.Binary(value)))
+        self.flush()
+
+    # ---- log consegne
+    def log_delivery(self, label: str, ok: int, total: int, elapsed: float) -> None:
+        now = time.time()
+        self._write("INSERT INTO delivery_log (ts, label, ok, total, elapsed) VALUES (?, ?, ?, ?, ?)",
+                    (now, label, ok, total, elapsed))
+        if random.random() < 0.01:
+            self._write("DELETE FROM delivery_log WHERE ts < ?", (now - DELIVERY_LOG_DAYS * 86400,))
+
+STORE = StateStore()
+
+class LeaderLease:
+    """Elezione del leader fra i worker tramite un lease nello store.
+
+    Il leader gestisce gli update Telegram (getUpdates o webhook) e il poller
+    delle circular; rinnova il lease ogni terzo di LEADER_LEASE_SEC. Se il
+    processo muore o si blocca, alla scadenza un altro worker subentra. Con un
+    solo worker il leader è sempre questo processo.
+    """
+
+    def __init__(self, store: StateStore, ttl: float = LEADER_LEASE_SEC):
+        self.store = store
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{WORKER_INDEX}"
+        self._leader = threading.Event()
+        self._follower = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_leader(self) -> bool:
+        return self._leader.is_set()
+
+    def wait_leader(self) -> None:
+        self._leader.wait()
+
+    def wait_lost(self) -> None:
+        """Ritorna quando questo processo perde il ruolo di leader."""
+        self._follower.wait()
+
+    def _set(self, leader: bool) -> None:
+        if leader != self._leader.is_set():
+            print(f"[Cluster] worker {WORKER_INDEX}: {'ora leader' if leader else 'non più leader'}")
+        (self._leader if leader else self._follower).set()
+        (self._follower if leader else self._leader).clear()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self._set(self.store.try_lease("leader_lease", self.owner, self.ttl))
+            except Exception as e:
+                print(f"[Cluster] errore lease: {e}")
+                self._set(False)
+            time.sleep(self.ttl / 3)
+
+    def start(self) -> None:
+        if WORKER_COUNT == 1:
+            self._leader.set()
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="leader-lease", daemon=True)
+            self._thread.start()
+
+LEADER = LeaderLease(STORE)
+
 # ==========================
 # KEYBOARDS
 # ==========================
@@ -216,66 +1161,319 @@ def keyboard_filters_inline(filters: Dict[str, bool]) -> dict:
 # ==========================
 # SUBSCRIBERS & FILTERS
 # ==========================
+FILTER_KEYS = ("gw", "swiftfermi", "circulars")
+
 def default_filters() -> Dict[str, bool]:
     return {"gw": False, "swiftfermi": True, "circulars": True}
 
-def get_user_entry(chat_id: int) -> Dict[str, Any]:
-    subs = load_json(SUBS_FILE, {})
-    entry = subs.get(str(chat_id))
+def _normalize_entry(entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Completa un record iscritto e migra i vecchi filtri swift/fermi in swiftfermi."""
     if not entry:
-        entry = {"filters": default_filters(), "muted": False}
-        subs[str(chat_id)] = entry
-        save_json(SUBS_FILE, subs)
-    f = entry.get("filters", {})
+        return {"filters": default_filters(), "muted": False}
+    f = entry.get("filters")
+    if not isinstance(f, dict):
+        f = default_filters()
     if "swift" in f or "fermi" in f:
         on = bool(f.get("swift", False) or f.get("fermi", False))
         f["swiftfermi"] = on
         f.pop("swift", None)
         f.pop("fermi", None)
-        entry["filters"] = f
-        subs[str(chat_id)] = entry
-        save_json(SUBS_FILE, subs)
+    entry["filters"] = f
+    entry.setdefault("muted", False)
     return entry
 
+# ======= Filtri sul cielo (regione, fascia di declinazione, FAR, errore) =======
+# Le regioni degli iscritti sono precompilate in un indice pixel HEALPix → chat:
+# il controllo di un alert è una ricerca per pixel, non un test geometrico per
+# ogni utente. La precisione è quella dei pixel dell'indice (~1.8° a NSIDE 32).
+SKY_INDEX_NSIDE = 32
+_SKY_GRID: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+def _fallback_sky_grid() -> Tuple[np.ndarray, np.ndarray]:
+    """Senza healpy: celle da 1°×1° (indice = riga di declinazione * 360 + colonna di RA)."""
+    global _SKY_GRID
+    if _SKY_GRID is None:
+        lon, lat = np.meshgrid(np.arange(360) + 0.5, np.arange(180) - 89.5)
+        _SKY_GRID = (lon.ravel(), lat.ravel())
+    return _SKY_GRID
+
+def sky_pixels(ra: Any, dec: Any) -> np.ndarray:
+    ra = np.mod(np.asarray(ra, dtype=float), 360.0)
+    dec = np.asarray(dec, dtype=float)
+    if HAVE_HEALPY:
+        return np.atleast_1d(hp.ang2pix(SKY_INDEX_NSIDE, ra, dec, lonlat=True))
+    j = np.clip(np.floor(dec + 90.0), 0, 179).astype(np.int64)
+    i = np.clip(np.floor(ra), 0, 359).astype(np.int64)
+    return np.atleast_1d(j * 360 + i)
+
+def sky_pixels_disc(ra: float, dec: float, radius: float) -> np.ndarray:
+    if HAVE_HEALPY:
+        vec = hp.ang2vec(ra, dec, lonlat=True)
+        return hp.query_disc(SKY_INDEX_NSIDE, vec, np.radians(radius), inclusive=True)
+    lon, lat = _fallback_sky_grid()
+    d0, l0 = np.radians(dec), np.radians(lat)
+    cos_sep = np.sin(d0) * np.sin(l0) + np.cos(d0) * np.cos(l0) * np.cos(np.radians(lon - ra))
+    sep = np.degrees(np.arccos(np.clip(cos_sep, -1.0, 1.0)))
+    return np.flatnonzero(sep <= radius + 0.71)   # mezza diagonale di una cella
+
+def sky_pixels_strip(dec_min: float, dec_max: float) -> np.ndarray:
+    if HAVE_HEALPY:
+        return hp.query_strip(SKY_INDEX_NSIDE, np.radians(90.0 - dec_max), np.radians(90.0 - dec_min),
+                              inclusive=True)
+    _, lat = _fallback_sky_grid()
+    return np.flatnonzero((lat >= dec_min - 0.5) & (lat <= dec_max + 0.5))
+
+def chat_sky_pixels(sky: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Pixel ammessi da regione e fascia di declinazione di una chat (None = tutto il cielo)."""
+    pix = None
+    region = sky.get("region")
+    if region:
+        pix = sky_pixels_disc(region["ra"], region["dec"], region["radius"])
+    band = sky.get("dec_band")
+    if band:
+        strip = sky_pixels_strip(band[0], band[1])
+        pix = strip if pix is None else np.intersect1d(pix, strip)
+    return pix
+
+def alert_sky_pixels(meta: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Pixel occupati da un alert: regione al 90% della skymap, cerchio d'errore o punto."""
+    if meta.get("region_pixels") is not None:
+        return np.asarray(meta["region_pixels"])
+    ra, dec = meta.get("ra"), meta.get("dec")
+    if ra is None or dec is None:
+        return None
+    err = meta.get("error_deg")
+    if err:
+        return sky_pixels_disc(float(ra), float(dec), float(err))
+    return sky_pixels(float(ra), float(dec))
+
+class SubscriberRegistry:
+    """Registro iscritti in memoria, condiviso fra i thread.
+
+    Gli iscritti si leggono una sola volta da `store`; ogni modifica aggiorna
+    solo la riga della chat interessata (commit raggruppati dallo store). Un indice
+    filtro → chat attive (non sospese) viene aggiornato a ogni modifica, così
+    i destinatari di un broadcast si ottengono senza scorrere tutti gli iscritti.
+    Allo stesso modo i filtri sul cielo (`entry["sky"]`) sono tenuti in un
+    indice pixel → chat e in tabelle di soglie per FAR ed errore. In cluster
+    `refresh()` rilegge periodicamente le chat modificate dal leader.
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self._lock = threading.RLock()
+        self._subs: Dict[str, Dict[str, Any]] = {}
+        self._index: Dict[str, Set[int]] = {k: set() for k in FILTER_KEYS}
+        self._sky_pix: Dict[int, Set[int]] = {}
+        self._sky_chat: Dict[int, np.ndarray] = {}
+        self._thresholds: Dict[str, Dict[int, float]] = {"max_far": {}, "max_err": {}}
+        self._loaded = False
+        self._synced = 0.0
+        self._refresher: Optional[threading.Thread] = None
+
+    def _ensure_loaded(self) -> None:
+        # chiamato sempre con il lock acquisito
+        if self._loaded:
+            return
+        self._synced = time.time()
+        for k, v in self.store.load_subscribers().items():
+            before = json.dumps(v, sort_keys=True)
+            self._subs[k] = _normalize_entry(v)
+            if before != json.dumps(self._subs[k], sort_keys=True):
+                self._persist(int(k))
+            self._reindex(int(k))
+        self._loaded = True
+
+    def _persist(self, chat_id: int) -> None:
+        # chiamato sempre con il lock acquisito
+        self.store.upsert_subscriber(chat_id, self._subs[str(chat_id)])
+
+    def _reindex(self, chat_id: int) -> None:
+        entry = self._subs.get(str(chat_id))
+        for key, members in self._index.items():
+            if entry and not entry.get("muted", False) and entry["filters"].get(key, False):
+                members.add(chat_id)
+            else:
+                members.discard(chat_id)
+        self._reindex_sky(chat_id, (entry or {}).get("sky") or {})
+
+    def _reindex_sky(self, chat_id: int, sky: Dict[str, Any]) -> None:
+        for p in self._sky_chat.pop(chat_id, np.empty(0, dtype=np.int64)).tolist():
+            members = self._sky_pix.get(p)
+            if members is not None:
+                members.discard(chat_id)
+                if not members:
+                    del self._sky_pix[p]
+        pix = chat_sky_pixels(sky)
+        if pix is not None:
+            self._sky_chat[chat_id] = pix
+            for p in pix.tolist():
+                self._sky_pix.setdefault(p, set()).add(chat_id)
+        for key, table in self._thresholds.items():
+            if sky.get(key) is None:
+                table.pop(chat_id, None)
+            else:
+                table[chat_id] = float(sky[key])
+
+    def _entry(self, chat_id: int, create: bool = True) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        key = str(chat_id)
+        entry = self._subs.get(key)
+        if entry is None and create:
+            entry = _normalize_entry(None)
+            self._subs[key] = entry
+            self._reindex(chat_id)
+            self._persist(chat_id)
+        return entry
+
+    def get(self, chat_id: int) -> Dict[str, Any]:
+        with self._lock:
+            return copy.deepcopy(self._entry(chat_id))
+
+    def add(self, chat_id: int) -> None:
+        with self._lock:
+            self._entry(chat_id)
+
+    def set_muted(self, chat_id: int, muted: bool) -> None:
+        with self._lock:
+            entry = self._entry(chat_id)
+            if entry.get("muted") != muted:
+                entry["muted"] = muted
+                self._reindex(chat_id)
+                self._persist(chat_id)
+
+    def set_filters(self, chat_id: int, **changes: Optional[bool]) -> None:
+        with self._lock:
+            f = self._entry(chat_id)["filters"]
+            changed = False
+            for key, value in changes.items():
+                if value is not None and f.get(key) != value:
+                    f[key] = value
+                    changed = True
+            if changed:
+                self._reindex(chat_id)
+                self._persist(chat_id)
+
+    def set_sky(self, chat_id: int, **changes: Any) -> None:
+        """Imposta (o con None rimuove) i filtri sul cielo: region, dec_band, max_far, max_err."""
+        with self._lock:
+            entry = self._entry(chat_id)
+            sky = dict(entry.get("sky") or {})
+            for key, value in changes.items():
+                if value is None:
+                    sky.pop(key, None)
+                else:
+                    sky[key] = value
+            if sky:
+                entry["sky"] = sky
+            else:
+                entry.pop("sky", None)
+            self._reindex(chat_id)
+            self._persist(chat_id)
+
+    def has_sky_filters(self) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            return bool(self._sky_chat) or any(self._thresholds.values())
+
+    def recipients(self, filter_key: str, meta: Optional[Dict[str, Any]] = None) -> List[int]:
+        """Chat non sospese con il filtro `filter_key` attivo (e, con `meta`, i cui filtri sul cielo accettano l'alert).
+
+        Un alert senza posizione, FAR o errore non viene scartato dal filtro corrispondente.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            members = self._index.get(filter_key, set())
+            if not meta or not (self._sky_chat or any(self._thresholds.values())):
+                return list(members)
+            excluded: Set[int] = set()
+            pix = alert_sky_pixels(meta) if self._sky_chat else None
+            if pix is not None:
+                inside = set().union(*(self._sky_pix.get(p, ()) for p in pix.tolist()))
+                excluded.update(cid for cid in self._sky_chat if cid not in inside)
+            for key, value in (("max_far", meta.get("far")), ("max_err", meta.get("error_deg"))):
+                table = self._thresholds[key]
+                if value is None or not table:
+                    continue
+                ids = np.fromiter(table.keys(), dtype=np.int64, count=len(table))
+                limits = np.fromiter(table.values(), dtype=float, count=len(table))
+                excluded.update(ids[limits < float(value)].tolist())
+            return [cid for cid in members if cid not in excluded]
+
+    def refresh(self) -> int:
+        """Applica le modifiche scritte da altri processi; restituisce quante chat sono cambiate."""
+        # finestra sovrapposta: le scritture degli altri processi diventano visibili al loro commit
+        since, self._synced = self._synced - 5 * STORE_COMMIT_DELAY - SUBS_REFRESH_SEC, time.time()
+        rows = self.store.load_subscribers(since)
+        changed = 0
+        with self._lock:
+            for k, v in rows.items():
+                entry = _normalize_entry(v)
+                if self._subs.get(k) != entry:
+                    self._subs[k] = entry
+                    self._reindex(int(k))
+                    changed += 1
+        return changed
+
+    def _refresh_loop(self) -> None:
+        while True:
+            time.sleep(SUBS_REFRESH_SEC)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"[Subscribers] errore refresh: {e}")
+
+    def flush(self) -> None:
+        self.store.flush()
+
+    def start(self) -> None:
+        self.store.start()
+        with self._lock:
+            self._ensure_loaded()
+            if WORKER_COUNT > 1 and self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name="subs-refresh", daemon=True)
+                self._refresher.start()
+
+SUBSCRIBERS = SubscriberRegistry(STORE)
+
+def get_user_entry(chat_id: int) -> Dict[str, Any]:
+    return SUBSCRIBERS.get(chat_id)
+
 def add_subscriber(chat_id: int):
-    get_user_entry(chat_id)
+    SUBSCRIBERS.add(chat_id)
 
 def set_muted(chat_id: int, muted: bool):
-    subs = load_json(SUBS_FILE, {})
-    entry = subs.get(str(chat_id), {"filters": default_filters(), "muted": False})
-    entry["muted"] = muted
-    subs[str(chat_id)] = entry
-    save_json(SUBS_FILE, subs)
+    SUBSCRIBERS.set_muted(chat_id, muted)
 
 def get_filters(chat_id: int) -> Dict[str, bool]:
     return get_user_entry(chat_id).get("filters", default_filters())
 
 def set_filters(chat_id: int, gw: Optional[bool]=None, swiftfermi: Optional[bool]=None, circulars: Optional[bool]=None):
-    subs = load_json(SUBS_FILE, {})
-    entry = subs.get(str(chat_id), {"filters": default_filters(), "muted": False})
-    f = entry.get("filters", default_filters())
-    if gw is not None: f["gw"] = gw
-    if swiftfermi is not None: f["swiftfermi"] = swiftfermi
-    if circulars is not None: f["circulars"] = circulars
-    entry["filters"] = f
-    subs[str(chat_id)] = entry
-    save_json(SUBS_FILE, subs)
-
-def list_subscribers() -> Dict[str, Dict[str, Any]]:
-    return load_json(SUBS_FILE, {})
+    SUBSCRIBERS.set_filters(chat_id, gw=gw, swiftfermi=swiftfermi, circulars=circulars)
 
 # ==========================
 # GRAFICA / IMMAGINI
 # ==========================
-def _bytes_from_plt() -> bytes:
-    fig = plt.gcf()
+# Le figure usano l'API a oggetti (Figure + canvas Agg): nessuno stato globale
+# di pyplot, quindi il rendering è sicuro in più thread o processi.
+SKYMAP_GRID_W = 720   # punti in longitudine della griglia di preview
+SKYMAP_GRID_H = 360   # punti in latitudine
+SKYMAP_PREVIEW_NSIDE = 256   # risoluzione massima usata per la preview (0 = mappa originale)
+
+def _new_figure() -> Figure:
+    fig = Figure(figsize=(8, 5), facecolor="white")
+    FigureCanvasAgg(fig)
+    return fig
+
+def _bytes_from_figure(fig: Figure) -> bytes:
     fig.patch.set_facecolor("white")
     buf = io.BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf, format="jpg", dpi=140, bbox_inches="tight", facecolor=fig.get_facecolor())
-    plt.close(fig)
-    buf.seek(0)
-    return buf.read()
+    try:
+        fig.tight_layout()
+    except Exception:
+        pass
+    fig.savefig(buf, format="jpg", dpi=140, bbox_inches="tight", facecolor=fig.get_facecolor())
+    return buf.getvalue()
 
 def draw_quick_card(title: str, lines: List[str]) -> bytes:
     W, H = 1000, 600
@@ -304,42 +1502,466 @@ def aitoff_from_radec(ra_deg: float, dec_deg: float, title="Localization (Aitoff
     if ra_plot > np.pi:
         ra_plot -= 2*np.pi
     dec_rad = np.deg2rad(dec_deg)
-    fig = plt.figure(figsize=(8, 5), facecolor="white")
-    ax = plt.subplot(111, projection="aitoff")
+    fig = _new_figure()
+    ax = fig.add_subplot(111, projection="aitoff")
     ax.grid(True, alpha=0.6)
     ax.set_title(title)
     ax.scatter(ra_plot, dec_rad, s=80)
-    return _bytes_from_plt()
+    return _bytes_from_figure(fig)
+
+def _preview_grid() -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Bordi (lon, lat) della griglia Mollweide e (theta, phi) HEALPix dei centri.
+
+    La longitudine del grafico è -RA, così l'RA cresce verso sinistra come in `hp.mollview`.
+    """
+    lon = np.linspace(-np.pi, np.pi, SKYMAP_GRID_W + 1)
+    lat = np.linspace(-np.pi / 2, np.pi / 2, SKYMAP_GRID_H + 1)
+    lon_c, lat_c = np.meshgrid(0.5 * (lon[:-1] + lon[1:]), 0.5 * (lat[:-1] + lat[1:]))
+    theta = np.pi / 2 - lat_c
+    phi = np.mod(-lon_c, 2 * np.pi)
+    return lon, lat, theta, phi
+
+def _plot_sky_grid(values: np.ndarray, lon: np.ndarray, lat: np.ndarray, title: str, unit: str = "prob",
+                   levels: Optional[np.ndarray] = None) -> bytes:
+    """Disegna la griglia; `levels` (livello di credibilità per punto) aggiunge i contorni 50%/90%."""
+    fig = _new_figure()
+    ax = fig.add_subplot(111, projection="mollweide")
+    vals = np.ma.masked_less_equal(values, 0)
+    vmax = float(vals.max()) if vals.count() else 1.0
+    mesh = ax.pcolormesh(lon, lat, vals, norm=LogNorm(vmin=vmax * 1e-4, vmax=vmax),
+                         cmap="viridis", shading="flat", rasterized=True)
+    ticks = np.arange(-150, 151, 30)
+    ax.set_xticks(np.deg2rad(ticks))
+    ax.set_xticklabels([f"{int((-t) % 360 // 15)}h" for t in ticks], fontsize=8)
+    if levels is not None:
+        lon_c, lat_c = 0.5 * (lon[:-1] + lon[1:]), 0.5 * (lat[:-1] + lat[1:])
+        ax.contour(lon_c, lat_c, levels, levels=[0.5, 0.9], colors="white", linewidths=[0.8, 1.2])
+    ax.grid(True, alpha=0.6)
+    ax.set_title(title, pad=14)
+    fig.colorbar(mesh, ax=ax, orientation="horizontal", fraction=0.05, pad=0.06, label=unit)
+    return _bytes_from_figure(fig)
+
+def credible_levels(density: np.ndarray, area: np.ndarray) -> Tuple[np.ndarray, float, float]:
+    """Livello di credibilità di ogni pixel e aree (deg²) delle regioni al 50% e 90%.
+
+    `density` è la densità di probabilità (per sr) e `area` l'area di ciascun
+    pixel in sr: vale sia per mappe piatte sia per pixel multi-ordine.
+    """
+    area = np.broadcast_to(area, density.shape)
+    prob = density * area
+    order = np.argsort(-density, kind="stable")
+    cum = np.cumsum(prob[order])
+    total = cum[-1] if cum.size and cum[-1] > 0 else 1.0
+    cum /= total
+    levels = np.empty_like(cum)
+    levels[order] = cum
+    cum_area = np.cumsum(area[order])
+    sr_to_deg2 = np.rad2deg(1) ** 2
+    def _area(p: float) -> float:
+        i = min(int(np.searchsorted(cum, p)), cum.size - 1)
+        return float(cum_area[i] * sr_to_deg2)
+    return levels, _area(0.5), _area(0.9)
+
+def _moc_order_ipix(uniq: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Scompone gli indici UNIQ in (order, ipix NESTED)."""
+    uniq = np.asarray(uniq, dtype=np.int64)
+    order = np.log2(uniq).astype(np.int64) // 2 - 1
+    # correzione per arrotondamenti di log2 vicino alle potenze di 4
+    order[uniq < (np.int64(1) << (2 * (order + 1)))] -= 1
+    return order, uniq - (np.int64(1) << (2 * (order + 1)))
+
+def rasterize_moc(uniq: np.ndarray, values: np.ndarray, theta: np.ndarray, phi: np.ndarray) -> np.ndarray:
+    """Valore del pixel multi-ordine che contiene ciascun punto (theta, phi).
+
+    Ogni pixel è espresso come intervallo di indici all'ordine massimo; i punti
+    della griglia si assegnano con una ricerca binaria, senza appiattire la mappa.
+    """
+    order, ipix = _moc_order_ipix(uniq)
+    max_order = int(order.max())
+    start = ipix << (2 * (max_order - order))
+    sort = np.argsort(start)
+    grid_pix = hp.ang2pix(1 << max_order, theta, phi, nest=True)
+    idx = np.searchsorted(start[sort], grid_pix, side="right") - 1
+    return np.asarray(values)[sort][np.clip(idx, 0, None)]
+
+def _plot_moc_skymap(uniq: np.ndarray, density: np.ndarray, title: str) -> bytes:
+    order, _ = _moc_order_ipix(uniq)
+    area = 4 * np.pi / (12 * 4.0 ** order)
+    levels, a50, a90 = credible_levels(density, area)
+    lon, lat, theta, phi = _preview_grid()
+    values = rasterize_moc(uniq, density, theta, phi) * np.deg2rad(1) ** 2
+    grid_levels = rasterize_moc(uniq, levels, theta, phi)
+    return _plot_sky_grid(values, lon, lat, f"{title} — 50%: {a50:.0f} deg² | 90%: {a90:.0f} deg²",
+                          unit="prob/deg²", levels=grid_levels)
+
+def _plot_flat_skymap(m: np.ndarray, nest: bool, title: str) -> bytes:
+    nside = hp.npix2nside(m.size)
+    pixarea = hp.nside2pixarea(nside)
+    levels, a50, a90 = credible_levels(m / pixarea, np.array(pixarea))
+    lon, lat, theta, phi = _preview_grid()
+    pix = hp.ang2pix(nside, theta, phi, nest=nest)
+    values = m[pix] / hp.nside2pixarea(nside, degrees=True)
+    return _plot_sky_grid(values, lon, lat, f"{title} — 50%: {a50:.0f} deg² | 90%: {a90:.0f} deg²",
+                          unit="prob/deg²", levels=levels[pix])
+
+def _iter_pixel_blocks(col: np.ndarray, block_pixels: int):
+    """Scorre una colonna HEALPix (1D o a vettori, anche memmap) a blocchi di pixel contigui."""
+    per_row = int(np.prod(col.shape[1:])) if col.ndim > 1 else 1
+    rows = max(1, block_pixels // per_row)
+    for r in range(0, col.shape[0], rows):
+        yield np.asarray(col[r:r + rows], dtype=float).ravel()
+
+def downsample_healpix(m: np.ndarray, nest: bool, nside_out: int) -> np.ndarray:
+    """Riduce una mappa di probabilità a `nside_out` conservando la probabilità totale.
+
+    Equivale a `hp.ud_grade(m, nside_out, power=-2)`; in ordinamento NESTED i
+    sottopixel di ogni pixel padre sono contigui, quindi la somma si fa a
+    blocchi senza riordinare né copiare l'intera mappa. `m` può essere la
+    colonna (memmap) della tabella FITS: viene letta un blocco alla volta.
+    """
+    nside_in = hp.npix2nside(m.size)
+    if not nside_out or nside_in <= nside_out or not nest:
+        full = np.concatenate(list(_iter_pixel_blocks(m, 1 << 22)))
+        if not nside_out or nside_in <= nside_out:
+            return full
+        return hp.ud_grade(full, nside_out, power=-2, order_in="RING")
+    factor = (nside_in // nside_out) ** 2
+    per_row = int(np.prod(m.shape[1:])) if m.ndim > 1 else 1
+    block = math.lcm(factor, per_row) * max(1, (1 << 22) // math.lcm(factor, per_row))  # ~4M pixel
+    return np.concatenate([b.reshape(-1, factor).sum(axis=1) for b in _iter_pixel_blocks(m, block)])
+
+# ==========================
+# DOWNLOAD E CACHE (streaming su disco, LRU)
+# ==========================
+CACHE_DIR = DATA_DIR / "cache"
+DOWNLOAD_CHUNK = 1 << 20             # 1 MiB
+CACHE_DISK_MAX_BYTES = 2 << 30       # 2 GiB fra skymap, immagini e preview
+CACHE_MEMORY_MAX_BYTES = 64 << 20    # oggetti piccoli (JPEG) tenuti anche in RAM
+
+def download_to_file(url: str, dest: Path, timeout: float = 60,
+                     headers: Optional[Dict[str, str]] = None) -> Optional[Tuple[Dict[str, str], str]]:
+    """Scarica `url` a blocchi in `dest` senza tenerlo in memoria.
+
+    Un contenuto gzip (es. `.fits.gz`) viene decompresso durante lo streaming,
+    così il file su disco si può aprire con `fits.open(..., memmap=True)`.
+    Restituisce (header della risposta, sha256 del contenuto) oppure None se
+    il server risponde 304 alla richiesta condizionale.
+    """
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.name}.{os.getpid()}.{threading.get_ident()}.part")
+    try:
+        with http_for(url).get(url, timeout=timeout, stream=True, headers=headers) as r:
+            if r.status_code == 304:
+                return None
+            r.raise_for_status()
+            inflater = None
+            digest = hashlib.sha256()
+            with open(tmp, "wb") as f:
+                for i, chunk in enumerate(r.iter_content(DOWNLOAD_CHUNK)):
+                    if i == 0 and chunk[:2] == b"\x1f\x8b":
+                        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    out = inflater.decompress(chunk) if inflater else chunk
+                    digest.update(out)
+                    f.write(out)
+                if inflater:
+                    out = inflater.flush()
+                    digest.update(out)
+                    f.write(out)
+            resp_headers = dict(r.headers)
+        os.replace(tmp, dest)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return resp_headers, digest.hexdigest()
+
+class ContentCache:
+    """Cache indirizzata per contenuto (sha256) con evizione LRU su disco e in memoria.
+
+    - `fetch(url)` scarica in cache, ricordando ETag/Last-Modified per URL: le
+      richieste successive sono condizionali e un 304 riusa il file su disco.
+    - `get_bytes`/`put_bytes` conservano oggetti derivati (es. preview JPEG)
+      sotto una chiave arbitraria; i piccoli restano anche in RAM.
+    Ogni accesso aggiorna l'mtime del file, usato come ordine LRU su disco.
+    """
+
+    def __init__(self, root: Path, disk_max_bytes: int = CACHE_DISK_MAX_BYTES,
+                 memory_max_bytes: int = CACHE_MEMORY_MAX_BYTES):
+        self.root = root
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._lock = threading.RLock()
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_bytes = 0
+        self._disk_bytes: Optional[int] = None
+        self._urls: Optional[Dict[str, Dict[str, Any]]] = None
+        self.counters: Dict[str, List[int]] = {}   # namespace -> [hit, miss]
+
+    def _count(self, ns: str, hit: bool) -> None:
+        with self._lock:
+            self.counters.setdefault(ns, [0, 0])[0 if hit else 1] += 1
+
+    def blob_path(self, key: str) -> Path:
+        return self.root / "blobs" / key[:2] / key
+
+    def _url_index(self) -> Dict[str, Dict[str, Any]]:
+        # chiamato sempre con il lock acquisito
+        if self._urls is None:
+            self._urls = load_json(str(self.root / "urls.json"), {})
+        return self._urls
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.memory_max_bytes // 8:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            self._mem_bytes -= len(old) if old is not None else 0
+            self._mem[key] = data
+            self._mem_bytes += len(data)
+            while self._mem_bytes > self.memory_max_bytes and self._mem:
+                _, dropped = self._mem.popitem(last=False)
+                self._mem_bytes -= len(dropped)
+
+    def _touch(self, path: Path) -> bool:
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def _added(self, nbytes: int) -> None:
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(p.stat().st_size for p in (self.root / "blobs").rglob("*") if p.is_file())
+            else:
+                self._disk_bytes += nbytes
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self.evict()
+
+    def evict(self) -> None:
+        """Elimina i file usati meno di recente finché la cache non scende al 90% del limite."""
+        with self._lock:
+            files = []
+            for p in (self.root / "blobs").rglob("*"):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                if p.is_file():
+                    files.append((st.st_mtime, st.st_size, p))
+            files.sort()
+            total = sum(f[1] for f in files)
+            target = int(self.disk_max_bytes * 0.9)
+            for _, size, p in files:
+                if total <= target:
+                    break
+                try:
+                    p.unlink()
+                    total -= size
+                except OSError:
+                    pass   # file in uso (es. memmap su Windows): resta fino al prossimo giro
+            self._disk_bytes = total
+
+    def get_bytes(self, key: str, ns: Optional[str] = None) -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+        path = self.blob_path(key)
+        if data is not None:
+            self._touch(path)
+        else:
+            try:
+                data = path.read_bytes()
+                self._touch(path)
+                self._remember(key, data)
+            except OSError:
+                data = None
+        if ns:
+            self._count(ns, data is not None)
+        return data
+
+    def put_bytes(self, key: str, data: bytes) -> None:
+        path = self.blob_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        self._remember(key, data)
+        self._added(len(data))
+
+    def fetch(self, url: str, ns: str = "download", timeout: float = 60) -> Tuple[Path, Dict[str, Any]]:
+        """Porta `url` in cache e restituisce (percorso del file, metadati)."""
+        with self._lock:
+            entry = dict(self._url_index().get(url) or {})
+        headers: Dict[str, str] = {}
+        if entry and self.blob_path(entry["key"]).exists():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        tmp = self.root / "tmp" / f"{uuid.uuid4().hex}.part"
+        result = download_to_file(url, tmp, timeout=timeout, headers=headers or None)
+        if result is None:
+            path = self.blob_path(entry["key"])
+            if self._touch(path):
+                self._count(ns, True)
+                return path, entry
+            # evitato nel frattempo: riscarica senza condizioni
+            result = download_to_file(url, tmp, timeout=timeout)
+        resp_headers, key = result
+        path = self.blob_path(key)
+        if path.exists():
+            tmp.unlink(missing_ok=True)
+            self._touch(path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, path)
+            self._added(path.stat().st_size)
+        entry = {
+            "key": key,
+            "etag": resp_headers.get("ETag"),
+            "last_modified": resp_headers.get("Last-Modified"),
+            "content_type": resp_headers.get("Content-Type", ""),
+        }
+        with self._lock:
+            urls = self._url_index()
+            urls[url] = entry
+            if len(urls) > 5000:
+                for old in list(urls)[:len(urls) - 5000]:
+                    urls.pop(old, None)
+            save_json(str(self.root / "urls.json"), urls)
+        self._count(ns, False)
+        return path, entry
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"counters": {k: tuple(v) for k, v in self.counters.items()},
+                    "memory_bytes": self._mem_bytes, "disk_bytes": self._disk_bytes or 0}
+
+CACHE = ContentCache(CACHE_DIR)
+
+def _skymap_columns(hdul) -> Optional[Tuple[str, np.ndarray, Any]]:
+    """("moc", UNIQ, PROBDENSITY) per le skymap multi-ordine, ("flat", PROB, nest) per quelle piatte."""
+    nest = False
+    if len(hdul) > 1 and getattr(hdul[1], "data", None) is not None:
+        nest = str(hdul[1].header.get("ORDERING", "RING")).upper().startswith("NEST")
+        data = hdul[1].data
+        if getattr(data, "dtype", None) is not None and getattr(data.dtype, "names", None):
+            if "UNIQ" in data.dtype.names and "PROBDENSITY" in data.dtype.names:
+                # skymap multi-ordine (igwn.gwalert): niente appiattimento
+                return "moc", np.asarray(data["UNIQ"]), np.asarray(data["PROBDENSITY"], dtype=float)
+            if "PROB" in data.dtype.names:
+                return "flat", data["PROB"], nest
+        return "flat", np.array(data).astype(float).squeeze(), nest
+    m = hdul[0].data
+    if m is None:
+        return None
+    return "flat", np.array(m, dtype=float).ravel(), nest
 
-def make_skymap_from_healpix_fits(url: str, title="Skymap") -> Optional[bytes]:
+def make_skymap_from_fits_file(path: Path, title="Skymap", nside: int = SKYMAP_PREVIEW_NSIDE) -> Optional[bytes]:
+    """Preview di una skymap HEALPix (piatta o multi-ordine) da file FITS già scaricato."""
     if not HAVE_HEALPY:
         return None
     try:
-        r = requests.get(url, timeout=60)
-        r.raise_for_status()
-        with fits.open(io.BytesIO(r.content)) as hdul:
-            if len(hdul) > 1 and getattr(hdul[1], "data", None) is not None:
-                data = hdul[1].data
-                if getattr(data, "dtype", None) is not None and getattr(data.dtype, "names", None):
-                    if "PROB" in data.dtype.names:
-                        m = np.array(data["PROB"], dtype=float)
-                    else:
-                        m = np.array(data).astype(float).squeeze()
-                else:
-                    m = np.array(data).astype(float).squeeze()
-            else:
-                m = hdul[0].data
-                if m is None:
-                    return None
-                m = np.array(m, dtype=float).squeeze()
-            plt.figure(figsize=(8, 5), facecolor="white")
-            hp.mollview(m, title=title, unit="prob", norm="log", min=1e-6, cbar=True)
-            hp.graticule()
-            return _bytes_from_plt()
+        with fits.open(str(path), memmap=True) as hdul:
+            cols = _skymap_columns(hdul)
+            if cols is None:
+                return None
+            kind, a, b = cols
+            if kind == "moc":
+                return _plot_moc_skymap(a, b, title)
+            m = downsample_healpix(a, b, nside)
+            return _plot_flat_skymap(m, b, title)
     except Exception as e:
         print(f"[Skymap] errore: {e}")
         return None
 
+def _moc_to_nest_prob(uniq: np.ndarray, density: np.ndarray, nside: int) -> np.ndarray:
+    """Probabilità di una skymap multi-ordine sommata sui pixel NESTED di `nside`."""
+    order, ipix = _moc_order_ipix(uniq)
+    prob = density * (4 * np.pi / (12 * 4.0 ** order))
+    out_order = int(np.log2(nside))
+    out = np.zeros(12 * nside * nside)
+    coarse = order > out_order
+    shift = 2 * (order[coarse] - out_order)
+    np.add.at(out, ipix[coarse] >> shift, prob[coarse])
+    for o in np.unique(order[~coarse]):
+        sel = order == o
+        n = 4 ** (out_order - int(o))   # pixel di `nside` contenuti in uno di ordine o
+        first = ipix[sel] * n
+        out[(first[:, None] + np.arange(n)).ravel()] += np.repeat(prob[sel] / n, n)
+    return out
+
+def skymap_region_pixels(path: Path, nside: int = SKY_INDEX_NSIDE, level: float = 0.9) -> Optional[np.ndarray]:
+    """Pixel RING di `nside` nella regione di credibilità `level` di una skymap FITS."""
+    if not HAVE_HEALPY:
+        return None
+    with fits.open(str(path), memmap=True) as hdul:
+        cols = _skymap_columns(hdul)
+        if cols is None:
+            return None
+        kind, a, b = cols
+        if kind == "moc":
+            m = hp.reorder(_moc_to_nest_prob(a, b, nside), n2r=True)
+        else:
+            m = downsample_healpix(a, b, nside)
+            if hp.npix2nside(m.size) != nside:
+                m = hp.ud_grade(m, nside, power=-2, order_in="NEST" if b else "RING", order_out="RING")
+            elif b:
+                m = hp.reorder(m, n2r=True)
+    order = np.argsort(m)[::-1]
+    cum = np.cumsum(m[order])
+    k = int(np.searchsorted(cum, level * cum[-1])) + 1
+    return np.sort(order[:k])
+
+# ==========================
+# RENDER SERVICE (process pool)
+# ==========================
+RENDER_PROCESSES = max(1, min(4, (os.cpu_count() or 2) - 1))
+RENDER_TIMEOUT = 300   # secondi massimi per un singolo rendering
+
+_RENDER_POOL: Optional[ProcessPoolExecutor] = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+def render_job(job: Dict[str, Any]) -> Any:
+    """Esegue un job nel processo worker: JPEG per "skymap"/"aitoff", pixel per "region"."""
+    kind = job.get("kind")
+    if kind == "region":
+        return skymap_region_pixels(Path(job["path"]), nside=job.get("nside", SKY_INDEX_NSIDE))
+    if kind == "skymap":
+        return make_skymap_from_fits_file(Path(job["path"]), title=job.get("title", "Skymap"),
+                                          nside=job.get("nside", SKYMAP_PREVIEW_NSIDE))
+    if kind == "aitoff":
+        return aitoff_from_radec(float(job["ra"]), float(job["dec"]), title=job.get("title", "Localization (Aitoff)"))
+    raise ValueError(f"job di rendering sconosciuto: {kind}")
+
+def _render_pool() -> ProcessPoolExecutor:
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is None:
+            # "spawn": i worker non ereditano thread e lock del processo principale
+            _RENDER_POOL = ProcessPoolExecutor(max_workers=RENDER_PROCESSES,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        return _RENDER_POOL
+
+def render(job: Dict[str, Any]) -> Any:
+    """Invia il job al pool di processi e attende il risultato (None se fallisce)."""
+    global _RENDER_POOL
+    pool = _render_pool()
+    try:
+        return pool.submit(render_job, job).result(timeout=RENDER_TIMEOUT)
+    except BrokenProcessPool:
+        print("[Render] pool di processi interrotto, verrà ricreato")
+        with _RENDER_POOL_LOCK:
+            if _RENDER_POOL is pool:
+                _RENDER_POOL = None
+    except FuturesTimeout:
+        print(f"[Render] timeout per {job.get('kind')}")
+    except Exception as e:
+        print(f"[Render] errore {job.get('kind')}: {e}")
+    return None
+
 # ---- Nuovi helper per immagini dagli alert ----
 def _find_image_url_in_obj(obj: Dict[str, Any]) -> Optional[str]:
     exts = (".png", ".jpg", ".jpeg")
@@ -369,11 +1991,10 @@ def _find_image_url_in_text(txt: str) -> Optional[str]:
 
 def _download_image_bytes(url: str) -> Optional[bytes]:
     try:
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        ct = r.headers.get("Content-Type", "").lower()
+        _, entry = CACHE.fetch(url, ns="image", timeout=30)
+        ct = (entry.get("content_type") or "").lower()
         if ("image/" in ct) or url.lower().endswith((".png", ".jpg", ".jpeg")):
-            return r.content
+            return CACHE.get_bytes(entry["key"])
     except Exception as e:
         print(f"[image] download error {url}: {e}")
     return None
@@ -394,7 +2015,7 @@ def _strip_html(text: str) -> str:
 
 def fetch_circular_body(url: str) -> Optional[str]:
     try:
-        r = requests.get(url, timeout=30)
+        r = http_for(url).get(url, timeout=30)
         r.raise_for_status()
         return r.text
     except Exception as e:
@@ -444,10 +2065,7 @@ def parse_ra_dec_from_text(text: str) -> Tuple[Optional[float], Optional[float],
 
     return ra_deg, dec_deg, unc_arcsec, ra_sex, dec_sex
 
-def extract_coords_from_circular(url: str) -> Tuple[Optional[float], Optional[float], Optional[float], Optional[str], Optional[str]]:
-    html = fetch_circular_body(url)
-    if not html:
-        return None, None, None, None, None
+def coords_from_circular_html(html: str) -> Tuple[Optional[float], Optional[float], Optional[float], Optional[str], Optional[str]]:
     txt = _strip_html(html)
     ra_deg, dec_deg, unc, ra_sex, dec_sex = parse_ra_dec_from_text(txt)
     if ra_deg is None or dec_deg is None:
@@ -463,16 +2081,17 @@ def fmt_float(x: Optional[float], nd=3) -> str:
     except Exception:
         return "—"
 
+_RADEC_PATTERNS = [re.compile(p, re.IGNORECASE | re.DOTALL) for p in (
+    r'RA\s*=\s*([+\-]?\d+(?:\.\d+)?)\D+DEC\s*=\s*([+\-]?\d+(?:\.\d+)?)',
+    r'RA\s*,\s*DEC\s*,\s*ERR\s*=\s*([+\-]?\d+(?:\.\d+)?)[,\s]+([+\-]?\d+(?:\.\d+)?)[,\s]+\d',
+    r'RA\s*\(J2000\)\s*([+\-]?\d+(?:\.\d+)?)\D+DEC\s*\(J2000\)\s*([+\-]?\d+(?:\.\d+)?)',
+    r'RA\s*[:]\s*([+\-]?\d+(?:\.\d+)?)\s*[,;]\s*DEC\s*[:]\s*([+\-]?\d+(?:\.\d+)?)',
+    r'RA\s*([+\-]?\d+(?:\.\d+)?)\s*deg\W+DEC\W*([+\-]?\d+(?:\.\d+)?)\s*deg',
+)]
+
 def _extract_radec(txt: str) -> Tuple[Optional[float], Optional[float]]:
-    patterns = [
-        r'RA\s*=\s*([+\-]?\d+(?:\.\d+)?)\D+DEC\s*=\s*([+\-]?\d+(?:\.\d+)?)',
-        r'RA\s*,\s*DEC\s*,\s*ERR\s*=\s*([+\-]?\d+(?:\.\d+)?)[,\s]+([+\-]?\d+(?:\.\d+)?)[,\s]+\d',
-        r'RA\s*\(J2000\)\s*([+\-]?\d+(?:\.\d+)?)\D+DEC\s*\(J2000\)\s*([+\-]?\d+(?:\.\d+)?)',
-        r'RA\s*[:]\s*([+\-]?\d+(?:\.\d+)?)\s*[,;]\s*DEC\s*[:]\s*([+\-]?\d+(?:\.\d+)?)',
-        r'RA\s*([+\-]?\d+(?:\.\d+)?)\s*deg\W+DEC\W*([+\-]?\d+(?:\.\d+)?)\s*deg',
-    ]
-    for pat in patterns:
-        m = re.search(pat, txt, re.IGNORECASE | re.DOTALL)
+    for pat in _RADEC_PATTERNS:
+        m = pat.search(txt)
         if m:
             try:
                 ra = float(m.group(1)); dec = float(m.group(2))
@@ -481,6 +2100,25 @@ def _extract_radec(txt: str) -> Tuple[Optional[float], Optional[float]]:
                 pass
     return None, None
 
+def _embedded_skymap_key(ev: Any) -> Optional[str]:
+    """Skymap multi-order inclusa nei notice igwn.gwalert (`event["skymap"]`, FITS in base64).
+
+    Il file viene salvato nella cache indirizzata per contenuto; restituisce la chiave.
+    """
+    data = ev.get("skymap") if isinstance(ev, dict) else None
+    if not isinstance(data, (str, bytes)) or not data:
+        return None
+    try:
+        raw = base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        return None
+    if not raw.startswith((b"SIMPLE", b"\x1f\x8b")):   # FITS, eventualmente gzip
+        return None
+    key = hashlib.sha256(raw).hexdigest()
+    if not CACHE.blob_path(key).exists():
+        CACHE.put_bytes(key, raw)
+    return key
+
 def parse_igwn_json(obj: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, Any]]:
     if not isinstance(obj, dict):
         return None, {}
@@ -513,16 +2151,18 @@ def parse_igwn_json(obj: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, Any]]
         f"🕒 GPS: {gps_time if gps_time is not None else '—'} | 📉 FAR: {fmt_float(far, 3)} Hz\n"
         f"🧪 Classificazione: {probs_str}"
     )
-    meta = {"type": "gw", "skymap_url": skymap_url, "image_url": image_url}
+    meta = {"type": "gw", "skymap_url": skymap_url, "image_url": image_url, "far": _float_or_none(far),
+            "skymap_key": _embedded_skymap_key(ev)}
     return caption, meta
 
 def parse_swift_guano_json(obj: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, Any]]:
     if not isinstance(obj, dict):
         return None, {}
     ntype = obj.get("notice_type") or obj.get("type") or ""
-    t0 = obj.get("event_time") or obj.get("time")
+    t0 = obj.get("trigger_time") or obj.get("event_time") or obj.get("time")
     name = obj.get("event_name") or obj.get("name") or ""
     ra = obj.get("ra"); dec = obj.get("dec")
+    err = obj.get("ra_dec_error")
     healpix = obj.get("skymap", {}).get("url") if isinstance(obj.get("skymap"), dict) else None
 
     is_grb = ("GRB" in str(name).upper()) or ("GRB" in str(ntype).upper())
@@ -538,45 +2178,277 @@ def parse_swift_guano_json(obj: Dict[str, Any]) -> Tuple[Optional[str], Dict[str
         f"🧾 Evento: {name or '—'}   🕒 T0: {t0 if t0 else '—'}\n"
         f"📍 RA: {fmt_float(ra)}  Dec: {fmt_float(dec)}"
     )
-    meta = {"type": "swiftfermi", "skymap_url": healpix, "image_url": image_url, "ra": ra, "dec": dec}
+    meta = {"type": "swiftfermi", "skymap_url": healpix, "image_url": image_url, "ra": ra, "dec": dec,
+            "error_deg": _float_or_none(err), "source": "swift", "event_time": iso_to_unix(t0)}
+    trigger = obj.get("id") or name
+    if trigger:
+        meta["event_key"] = f"swift:{trigger}"
     return caption, meta
 
+# ======= Notice GCN classic in formato testo ("CHIAVE:   valore") =======
+_LEADING_NUMBER = re.compile(r'\s*([+\-]?\d+(?:\.\d*)?(?:[eE][+\-]?\d+)?)')
+_GRB_WORD = re.compile(r'GRB', re.I)
+_GRB_NAME = re.compile(r'GRB\s+\d{6}[A-Z]?', re.I)
+
+def parse_classic_text(txt: str) -> Dict[str, str]:
+    """Divide un notice classic in un dict CHIAVE → valore, in una sola passata.
+
+    Le righe indentate continuano la chiave precedente; le chiavi ripetute
+    (es. COMMENTS) vengono unite con un a capo.
+    """
+    fields: Dict[str, str] = {}
+    key = None
+    for line in txt.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in " \t":
+            if key is not None:
+                fields[key] += "\n" + line.strip()
+            continue
+        name, sep, value = line.partition(":")
+        if not sep or not name.replace("_", "").isalnum():
+            key = None
+            continue
+        key = name.upper()
+        value = value.strip()
+        fields[key] = fields[key] + "\n" + value if key in fields else value
+    return fields
+
+def classic_float(value: Optional[str]) -> Optional[float]:
+    """Primo numero di un valore classic ('123.450d {+08h 13m 48s} (J2000),' → 123.45)."""
+    if not value:
+        return None
+    m = _LEADING_NUMBER.match(value)
+    return float(m.group(1)) if m else None
+
+SAMPLE_FERMI_NOTICE = """TITLE:            GCN/FERMI NOTICE
+NOTICE_DATE:      Fri 01 Mar 24 12:00:31 UT
+NOTICE_TYPE:      Fermi-GBM Flight Position
+RECORD_NUM:       1
+TRIGGER_NUM:      731000000
+GRB_DATE:         20370 TJD;    61 DOY;   24/03/01
+GRB_TIME:         43200.00 SOD {12:00:00.00} UT
+GRB_RA:           123.450d {+08h 13m 48s} (J2000),
+                  123.520d {+08h 14m 05s} (current),
+                  122.790d {+08h 11m 10s} (1950)
+GRB_DEC:          -45.670d {-45d 40' 12"} (J2000),
+                  -45.700d {-45d 42' 00"} (current),
+                  -45.510d {-45d 30' 36"} (1950)
+GRB_ERROR:        7.50 [deg radius, statistical only]
+GRB_INTEN:        25 [cnts/sec]
+DATA_SIGNIF:      8.20 [sigma]
+INTEG_TIME:       0.256 [sec]
+HARD_RATIO:       0.90
+LOC_ALGORITHM:    3 (version number of)
+MOST_LIKELY:       95%  GRB
+2nd_MOST_LIKELY:    3%  Generic SGR
+DETECTORS:        0,0,1, 1,0,0, 0,0,0, 0,1,0, 0,0,
+LC_URL:           http://heasarc.gsfc.nasa.gov/FTP/fermi/data/gbm/triggers/2024/bn240301500/quicklook/glg_lc_medres34_bn240301500.gif
+LOC_URL:          http://heasarc.gsfc.nasa.gov/FTP/fermi/data/gbm/triggers/2024/bn240301500/quicklook/glg_locplot_all_bn240301500.png
+COMMENTS:         Fermi-GBM alert.
+COMMENTS:         The LC_URL file will not be created until ~15 min after the trigger.
+"""
+
+def bench_fermi_parser(n: int = 20000) -> None:
+    """Micro-benchmark: parser classic a chiavi contro le sole regex di `_extract_radec`."""
+    txt = SAMPLE_FERMI_NOTICE
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fields = parse_classic_text(txt)
+        kv = (classic_float(fields.get("GRB_RA")), classic_float(fields.get("GRB_DEC")))
+    t_kv = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        rx = _extract_radec(txt)
+    t_rx = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        parse_fermi_text(txt)
+    t_full = time.perf_counter() - t0
+    print(f"[bench] chiavi  : {t_kv / n * 1e6:7.1f} µs/notice → RA/Dec {kv}")
+    print(f"[bench] regex   : {t_rx / n * 1e6:7.1f} µs/notice → RA/Dec {rx}")
+    print(f"[bench] completo: {t_full / n * 1e6:7.1f} µs/notice (parse_fermi_text)")
+
 def parse_fermi_text(txt: str) -> Tuple[Optional[str], Dict[str, Any]]:
-    if "GRB" not in txt.upper():
+    if not _GRB_WORD.search(txt):
         return None, {}
-    ra, dec = _extract_radec(txt)
+    fields = parse_classic_text(txt)
+    ra = classic_float(fields.get("GRB_RA"))
+    dec = classic_float(fields.get("GRB_DEC"))
+    if ra is None or dec is None:
+        # testo non in formato a chiavi: vecchie euristiche
+        ra, dec = _extract_radec(txt)
+    if ra is None or dec is None:
+        return fermi_alert(None, None, None, None, None, None, _find_image_url_in_text(txt))
+    m2 = _GRB_NAME.search(txt)
+    image_url = _find_image_url_in_text(fields.get("LOC_URL") or "") or _find_image_url_in_text(txt)
+    return fermi_alert(ra, dec, classic_float(fields.get("GRB_ERROR")),
+                       fields.get("TRIGGER_NUM") or fields.get("TRIGGER_ID"), fields.get("NOTICE_TYPE"),
+                       m2.group(0) if m2 else None, image_url,
+                       event_time=tjd_sod_to_unix(classic_float(fields.get("GRB_DATE")),
+                                                  classic_float(fields.get("GRB_TIME"))))
+
+def tjd_sod_to_unix(tjd: Optional[float], sod: Optional[float]) -> Optional[float]:
+    """Truncated Julian Day + secondi del giorno (formato dei notice classic) → tempo Unix."""
+    if tjd is None or sod is None:
+        return None
+    return (tjd + 40000.0 - 40587.0) * 86400.0 + sod   # MJD = TJD + 40000; epoca Unix = MJD 40587
+
+def iso_to_unix(value: Any) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+def fermi_alert(ra: Optional[float], dec: Optional[float], err: Optional[float], trigger: Optional[str],
+                notice_type: Optional[str], grb_name: Optional[str], image_url: Optional[str],
+                event_time: Optional[float] = None) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Caption e meta di un alert Fermi-GBM, qualunque sia il formato del notice."""
     if ra is None or dec is None:
-        img = _find_image_url_in_text(txt)
-        if not img:
+        if not image_url:
             return None, {}
         caption = (
             f"⚡ <b>Fermi-GBM alert</b>\n"
             f"🧾 Evento: GRB (dettagli nel notice)\n"
             f"📍 RA/Dec non disponibili nel notice"
         )
-        meta = {"type": "swiftfermi", "ra": None, "dec": None, "image_url": img}
+        meta = {"type": "swiftfermi", "ra": None, "dec": None, "trigger": trigger,
+                "notice_type": notice_type, "image_url": image_url}
         return caption, meta
-    ev = None
-    for pat in [r'GRB\s+\d{6}[A-Z]?', r'TRIGGER[_\s]*ID[:=\s]+(\S+)', r'NOTICE_TYPE:\s*(.+)']:
-        m2 = re.search(pat, txt, re.I)
-        if m2:
-            ev = m2.group(0)
-            break
-    image_url = _find_image_url_in_text(txt)
+    if grb_name:
+        ev = grb_name
+    elif trigger:
+        ev = f"Trigger {trigger}" + (f" ({notice_type})" if notice_type else "")
+    else:
+        ev = notice_type
     caption = (
         f"⚡ <b>Fermi-GBM alert</b>\n"
         f"🧾 Evento: {ev or '—'}\n"
         f"📍 RA: {fmt_float(ra)}  Dec: {fmt_float(dec)}"
+        + (f"  ±{fmt_float(err, 2)}°" if err is not None else "")
     )
-    meta = {"type": "swiftfermi", "ra": ra, "dec": dec, "image_url": image_url}
+    meta = {"type": "swiftfermi", "ra": ra, "dec": dec, "error_deg": err, "source": "fermi",
+            "event_time": event_time, "trigger": trigger, "notice_type": notice_type, "image_url": image_url}
+    if trigger:
+        # i notice successivi dello stesso trigger aggiornano lo stesso messaggio
+        meta["event_key"] = f"fermi:{trigger}"
+        meta["event_rank"] = GBM_EVENT_RANK.get(notice_type or "", 0)
     return caption, meta
 
+# ======= VOEvent (Fermi GBM) =======
+# Packet_Type dei notice GBM → nome del notice
+GBM_PACKET_TYPES = {
+    "110": "Fermi-GBM Alert",
+    "111": "Fermi-GBM Flight Position",
+    "112": "Fermi-GBM Ground Position",
+    "115": "Fermi-GBM Final Position",
+}
+# ordine dei notice di uno stesso trigger: un notice non sostituisce mai uno più raffinato
+GBM_EVENT_RANK = {name: rank for rank, name in enumerate(GBM_PACKET_TYPES.values())}
+
+def _float_or_none(s: Optional[str]) -> Optional[float]:
+    try:
+        return float(s) if s is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def parse_voevent(raw: bytes) -> Optional[Dict[str, Any]]:
+    """Legge un VOEvent in streaming: Param (anche dentro i Group), posizione ed errore.
+
+    Restituisce None se l'XML non è valido o non è un VOEvent.
+    """
+    out: Dict[str, Any] = {"params": {}, "ivorn": None, "ra": None, "dec": None, "err": None, "time": None}
+    params = out["params"]
+    root_seen = False
+    try:
+        for event, el in ET.iterparse(io.BytesIO(raw), events=("start", "end")):
+            tag = el.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if not root_seen:
+                    root_seen = True
+                    if tag != "VOEvent":
+                        return None
+                    out["ivorn"] = el.get("ivorn")
+                continue
+            if tag == "Param":
+                name = el.get("name")
+                if name:
+                    params[name] = el.get("value")
+            elif tag == "C1":
+                out["ra"] = _float_or_none(el.text)
+            elif tag == "C2":
+                out["dec"] = _float_or_none(el.text)
+            elif tag == "Error2Radius":
+                out["err"] = _float_or_none(el.text)
+            elif tag == "ISOTime":
+                out["time"] = (el.text or "").strip() or None
+            el.clear()
+    except ET.ParseError:
+        return None
+    return out if root_seen else None
+
+def parse_fermi_voevent(raw: bytes) -> Tuple[Optional[str], Dict[str, Any]]:
+    voe = parse_voevent(raw)
+    if voe is None:
+        return None, {}
+    params = voe["params"]
+    if str(params.get("Def_NOT_a_GRB", "")).lower() == "true":
+        return None, {}
+    image_url = params.get("LocationMap_URL")
+    if image_url and not image_url.lower().endswith((".png", ".jpg", ".jpeg")):
+        image_url = None
+    return fermi_alert(voe["ra"], voe["dec"], voe["err"], params.get("TrigID"),
+                       GBM_PACKET_TYPES.get(str(params.get("Packet_Type"))), None, image_url,
+                       event_time=iso_to_unix(voe["time"]))
+
+# ======= Decoder per topic =======
+def loads_json(raw: bytes) -> Any:
+    return orjson.loads(raw) if HAVE_ORJSON else json.loads(raw)
+
 def try_load_json(raw: bytes) -> Optional[Any]:
     try:
-        return json.loads(raw.decode("utf-8"))
+        return loads_json(raw)
     except Exception:
         return None
 
+DECODERS: Dict[str, Callable[[bytes], Tuple[Optional[str], Dict[str, Any]]]] = {}
+
+def register_decoder(*topics: str):
+    """Associa un decoder (bytes → caption, meta) a uno o più topic (o prefissi di topic)."""
+    def deco(fn):
+        for t in topics:
+            DECODERS[t] = fn
+        return fn
+    return deco
+
+def decoder_for(topic: str) -> Optional[Callable[[bytes], Tuple[Optional[str], Dict[str, Any]]]]:
+    fn = DECODERS.get(topic)
+    if fn is None:
+        for prefix, cand in DECODERS.items():
+            if topic.startswith(prefix):
+                return cand
+    return fn
+
+def _json_dict_decoder(parse: Callable[[Dict[str, Any]], Tuple[Optional[str], Dict[str, Any]]]):
+    def decode(raw: bytes) -> Tuple[Optional[str], Dict[str, Any]]:
+        obj = try_load_json(raw)
+        return parse(obj) if isinstance(obj, dict) else (None, {})
+    return decode
+
+register_decoder("igwn.gwalert")(_json_dict_decoder(parse_igwn_json))
+register_decoder("gcn.notices.swift.bat.guano")(_json_dict_decoder(parse_swift_guano_json))
+
+@register_decoder("gcn.classic.text.FERMI_GBM_")
+def _decode_fermi_text(raw: bytes) -> Tuple[Optional[str], Dict[str, Any]]:
+    return parse_fermi_text(raw.decode("utf-8", errors="replace"))
+
+register_decoder("gcn.classic.voevent.FERMI_GBM_")(parse_fermi_voevent)
+
 def event_kind_to_filter_key(kind: str) -> str:
     if kind == "gw":
         return "gw"
@@ -589,9 +2461,8 @@ def event_kind_to_filter_key(kind: str) -> str:
 # ==========================
 # DISPATCH / BROADCAST
 # ==========================
-def build_and_send_with_image(caption: str, meta: Dict[str, Any]):
-    kind = meta.get("type", "swiftfermi")
-    skymap_url = meta.get("skymap_url")
+def build_alert_image(caption: str, meta: Dict[str, Any]) -> bytes:
+    """Immagine per l'alert: preview/quicklook, poi skymap HEALPix, Aitoff da RA/Dec, infine card testuale."""
     ra = meta.get("ra")
     dec = meta.get("dec")
     image_url = meta.get("image_url")
@@ -599,81 +2470,560 @@ def build_and_send_with_image(caption: str, meta: Dict[str, Any]):
     img_bytes = None
     if image_url:
         img_bytes = _download_image_bytes(str(image_url))
-    if img_bytes is None and skymap_url and (str(skymap_url).endswith(".fits") or str(skymap_url).endswith(".fits.gz")):
-        img_bytes = make_skymap_from_healpix_fits(skymap_url, title="Skymap")
+    if img_bytes is None and HAVE_HEALPY:
+        img_bytes = render_alert_skymap(meta, title="Skymap")
     if img_bytes is None and (ra is not None and dec is not None):
         try:
-            img_bytes = aitoff_from_radec(float(ra), float(dec), title="Localization (Aitoff)")
+            img_bytes = render_cached(
+                f"aitoff|{float(ra):.5f}|{float(dec):.5f}",
+                {"kind": "aitoff", "ra": float(ra), "dec": float(dec), "title": "Localization (Aitoff)"},
+            )
         except Exception:
             img_bytes = None
     if img_bytes is None:
         lines = [l for l in caption.split("\n")[1:6]]
         img_bytes = draw_quick_card(title=caption.split("\n")[0], lines=lines)
+    return img_bytes
 
-    subs = list_subscribers()
-    for k, v in subs.items():
-        chat_id = int(k)
-        entry = get_user_entry(chat_id)
-        if entry.get("muted", False):
-            continue
-        filters = entry.get("filters", default_filters())
-        if not filters.get(event_kind_to_filter_key(kind), False):
-            continue
-        try:
-            tg_send_photo_bytes(chat_id, img_bytes, caption=caption)
-        except Exception as e:
-            print(f"[broadcast] chat {chat_id} photo error: {e}")
+def enqueue_alert(caption: str, meta: Dict[str, Any], img_bytes: bytes):
+    kind = meta.get("type", "swiftfermi")
+    OUTBOX.enqueue_photo(
+        SUBSCRIBERS.recipients(event_kind_to_filter_key(kind), meta),
+        img_bytes,
+        caption=caption,
+        label=_strip_html(caption.split("\n")[0]),
+        event_key=meta.get("event_key"),
+        event_rank=int(meta.get("event_rank") or 0),
+    )
 
 def send_one_with_image(chat_id: int, caption: str, meta: Dict[str, Any]):
-    skymap_url = meta.get("skymap_url")
-    ra = meta.get("ra")
-    dec = meta.get("dec")
-    image_url = meta.get("image_url")
+    tg_send_photo_bytes(chat_id, build_alert_image(caption, meta), caption=caption)
+
+def render_cached(key: str, job: Dict[str, Any]) -> Optional[bytes]:
+    """Come `render`, ma riusa la preview già prodotta per la stessa chiave."""
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    img = CACHE.get_bytes(digest, ns="render")
+    if img is None:
+        img = render(job)
+        if img:
+            CACHE.put_bytes(digest, img)
+    return img
+
+def alert_skymap_file(meta: Dict[str, Any]) -> Optional[Tuple[Path, str]]:
+    """(file in cache, chiave) della skymap dell'alert: inclusa nel notice oppure scaricata da `skymap_url`."""
+    key = meta.get("skymap_key")
+    if key and CACHE.blob_path(key).exists():
+        return CACHE.blob_path(key), key
+    url = str(meta.get("skymap_url") or "")
+    if not url.endswith((".fits", ".fits.gz")):
+        return None
+    try:
+        path, entry = CACHE.fetch(url, ns="skymap")
+    except Exception as e:
+        print(f"[Skymap] download fallito: {e}")
+        return None
+    return path, entry["key"]
 
-    img_bytes = None
-    if image_url:
-        img_bytes = _download_image_bytes(str(image_url))
-    if img_bytes is None and skymap_url and (str(skymap_url).endswith(".fits") or str(skymap_url).endswith(".fits.gz")):
-        img_bytes = make_skymap_from_healpix_fits(skymap_url, title="Skymap")
-    if img_bytes is None and (ra is not None and dec is not None):
-        try:
-            img_bytes = aitoff_from_radec(float(ra), float(dec), title="Localization (Aitoff)")
-        except Exception:
-            img_bytes = None
-    if img_bytes is None:
-        lines = [l for l in caption.split("\n")[1:6]]
-        img_bytes = draw_quick_card(title=caption.split("\n")[0], lines=lines)
-    tg_send_photo_bytes(chat_id, img_bytes, caption=caption)
+def alert_skymap_region(meta: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Pixel della regione al 90% della skymap dell'alert (per i filtri sul cielo degli iscritti)."""
+    found = alert_skymap_file(meta)
+    if found is None:
+        return None
+    return render({"kind": "region", "path": str(found[0]), "nside": SKY_INDEX_NSIDE})
+
+def render_alert_skymap(meta: Dict[str, Any], title: str = "Skymap") -> Optional[bytes]:
+    """Porta la skymap in cache (in questo thread) e la fa disegnare al pool di processi."""
+    found = alert_skymap_file(meta)
+    if found is None:
+        return None
+    path, digest = found
+    key = f"skymap|{digest}|{title}|{SKYMAP_PREVIEW_NSIDE}|{SKYMAP_GRID_W}x{SKYMAP_GRID_H}"
+    return render_cached(key, {"kind": "skymap", "path": str(path), "title": title})
+
+# ==========================
+# PIPELINE (ingest → parse → render → fan-out)
+# ==========================
+STAGE_QUEUE_SIZE = 100   # elementi massimi in attesa per stadio
+STAGE_MAX_ATTEMPTS = 5   # tentativi per elemento prima della dead letter
+STAGE_RETRY_BASE = 2.0   # secondi, raddoppia a ogni tentativo
+PARSE_WORKERS = 1
+RENDER_WORKERS = RENDER_PROCESSES + 1   # un thread in più per i download mentre i processi disegnano
+FANOUT_STAGE_WORKERS = 1
+COALESCE_SEC = 20.0      # aggiornamenti dello stesso evento entro questa finestra → un solo render
+EVENT_MATCH_WINDOW_SEC = 120.0   # notice di strumenti diversi entro questo intervallo...
+EVENT_MATCH_MIN_DEG = 1.0        # ...e entro max(questo, somma degli errori) gradi → stesso evento
+EVENT_INDEX_TTL = 6 * 3600
+
+EVENT_SOURCES = {"swift": "Swift-BAT", "fermi": "Fermi-GBM"}
+
+def _unit_vector(ra_deg: float, dec_deg: float) -> np.ndarray:
+    ra, dec = np.radians(ra_deg), np.radians(dec_deg)
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+class EventIndex:
+    """Eventi recenti con posizione, per riconoscere lo stesso GRB visto da più strumenti.
+
+    Un notice appartiene a un evento già noto se ha la stessa `event_key`,
+    oppure se cade entro EVENT_MATCH_WINDOW_SEC e a una separazione angolare
+    compatibile con gli errori (confronto vettoriale su tutti gli eventi
+    recenti). Il confronto temporale usa solo i tempi di trigger: un notice
+    senza `event_time` si unisce solo per chiave. Per posizione ci si unisce
+    solo a eventi senza notice dello stesso strumento (due trigger Fermi
+    vicini restano eventi distinti). Gli eventi uniti condividono la chiave,
+    quindi il messaggio già inviato viene modificato con una didascalia
+    combinata.
+
+    L'indice è in memoria: in cluster correla solo i notice consumati dallo
+    stesso worker. Il rango in uscita (somma di rango + 1 delle sorgenti) non
+    decresce mai per un evento e dipende solo dai notice, così l'outbox può
+    rifiutare anche gli aggiornamenti meno recenti arrivati da altri worker.
+    """
+
+    def __init__(self, window: float = EVENT_MATCH_WINDOW_SEC, ttl: float = EVENT_INDEX_TTL):
+        self.window = window
+        self.ttl = ttl
+        self._events: List[Dict[str, Any]] = []
+        self._t = np.empty(0)
+        self._xyz = np.empty((0, 3))
+        self._err = np.empty(0)
+        self._lock = threading.Lock()
+        self.merged = 0
+
+    def _prune(self, now: float) -> None:
+        keep = np.array([now - ev["seen"] <= self.ttl for ev in self._events], dtype=bool)
+        if keep.size and not keep.all():
+            self._events = [ev for ev, k in zip(self._events, keep) if k]
+            self._t, self._xyz, self._err = self._t[keep], self._xyz[keep], self._err[keep]
+
+    def _match(self, key: Optional[str], source: str, t: Optional[float], xyz: np.ndarray,
+               err: float) -> Optional[int]:
+        if key:
+            for i, ev in enumerate(self._events):
+                if key in ev["aliases"]:
+                    return i
+        if t is None or not self._events:
+            return None
+        # un evento con già un trigger di questo strumento è un altro GRB, per quanto vicino
+        free = np.array([source not in ev["sources"] for ev in self._events], dtype=bool)
+        sep = np.degrees(np.arccos(np.clip(self._xyz @ xyz, -1.0, 1.0)))
+        ok = free & (np.abs(self._t - t) <= self.window) & (sep <= np.maximum(EVENT_MATCH_MIN_DEG, self._err + err))
+        if not ok.any():
+            return None
+        idx = np.flatnonzero(ok)
+        return int(idx[np.argmin(sep[idx])])
+
+    def correlate(self, caption: str, meta: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Caption e meta da inoltrare (eventualmente combinati), o None se il notice è superato."""
+        ra, dec, source = meta.get("ra"), meta.get("dec"), meta.get("source")
+        if ra is None or dec is None or not source:
+            return caption, meta
+        now = time.time()
+        t = meta.get("event_time")   # tempo di trigger; l'ora di ricezione non è confrontabile
+        err = float(meta.get("error_deg") or 0.0)
+        xyz = _unit_vector(float(ra), float(dec))
+        rank = meta.get("event_rank", 0)
+        with self._lock:
+            self._prune(now)
+            i = self._match(meta.get("event_key"), source, t, xyz, err)
+            if i is None:
+                ev = {"key": meta.get("event_key") or f"evt:{uuid.uuid4().hex[:12]}", "sources": {}}
+                ev["aliases"] = {ev["key"]}
+                self._events.append(ev)
+                self._t = np.append(self._t, np.nan if t is None else t)   # NaN: mai nella finestra
+                self._xyz = np.vstack([self._xyz, xyz])
+                self._err = np.append(self._err, err)
+            else:
+                ev = self._events[i]
+                prev = ev["sources"].get(source)
+                if prev is not None and rank < prev[0]:
+                    return None
+                if source not in ev["sources"]:
+                    self.merged += 1
+                    print(f"[Eventi] {meta.get('event_key') or source} unito a {ev['key']}")
+                if err <= self._err[i] or prev is not None and len(ev["sources"]) == 1:
+                    # posizione più precisa (o aggiornamento dell'unica sorgente)
+                    self._xyz[i], self._err[i] = xyz, err
+                if t is not None and np.isnan(self._t[i]):
+                    self._t[i] = t
+            ev["seen"] = now
+            if meta.get("event_key"):
+                ev["aliases"].add(meta["event_key"])
+            ev["sources"][source] = (rank, caption, meta)
+            sources = dict(ev["sources"])
+            key = ev["key"]
+
+        # immagine e posizione dalla sorgente meglio localizzata
+        best = min(sources.values(), key=lambda s: s[2].get("error_deg") if s[2].get("error_deg") is not None
+                   else float("inf"))[2]
+        out_meta = dict(best, event_key=key, event_rank=sum(s[0] + 1 for s in sources.values()))
+        if len(sources) == 1:
+            return caption, out_meta
+        names = " + ".join(EVENT_SOURCES.get(s, s) for s in sources)
+        combined = f"🔗 <b>Evento correlato</b> ({names})\n\n" + "\n\n".join(s[1] for s in sources.values())
+        return combined, out_meta
+
+class Stage:
+    """Stadio della pipeline: coda limitata servita da `workers` thread.
+
+    `handler(item)` restituisce l'elemento per lo stadio successivo oppure
+    None per scartarlo. `put()` blocca quando la coda è piena, così uno stadio
+    lento rallenta chi lo alimenta invece di accumulare memoria. Se l'handler
+    fallisce, l'elemento viene ritentato con backoff; dopo STAGE_MAX_ATTEMPTS
+    passa a `dead_letter(nome_stadio, elemento, errore)`.
+    """
+
+    def __init__(self, name: str, handler: Callable[[Any], Any], workers: int = 1,
+                 maxsize: int = STAGE_QUEUE_SIZE,
+                 dead_letter: Optional[Callable[[str, Any, Exception], None]] = None):
+        self.name = name
+        self.handler = handler
+        self.dead_letter = dead_letter
+        self.workers = workers
+        self.queue: "queue.Queue[Tuple[float, Any, int]]" = queue.Queue(maxsize=maxsize)
+        self.next: Optional["Stage"] = None
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    def put(self, item: Any, attempt: int = 0) -> None:
+        self.queue.put((time.monotonic(), item, attempt))
+
+    def _retry(self, item: Any, attempt: int, err: Exception) -> None:
+        if attempt < STAGE_MAX_ATTEMPTS:
+            t = threading.Timer(STAGE_RETRY_BASE * 2 ** (attempt - 1), self.put, args=(item, attempt))
+            t.daemon = True
+            t.start()
+        elif self.dead_letter is not None:
+            self.dead_letter(self.name, item, err)
+
+    def _run(self) -> None:
+        while True:
+            t_in, item, attempt = self.queue.get()
+            t0 = time.monotonic()
+            failed = False
+            try:
+                out = self.handler(item)
+                if out is not None and self.next is not None:
+                    self.next.put(out)
+            except Exception as e:
+                failed = True
+                print(f"[Pipeline] {self.name} errore (tentativo {attempt + 1}): {e}")
+                self._retry(item, attempt + 1, e)
+            finally:
+                with self._lock:
+                    self.processed += 1
+                    self.errors += failed
+                    self.wait_time += t0 - t_in
+                    self.run_time += time.monotonic() - t0
+                self.queue.task_done()
+
+    def start(self) -> None:
+        for i in range(self.workers - len(self._threads)):
+            t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.processed or 1
+            return {"depth": self.queue.qsize(), "processed": self.processed, "errors": self.errors,
+                    "wait_ms": 1000 * self.wait_time / n, "run_ms": 1000 * self.run_time / n}
+
+class Coalescer:
+    """Raggruppa gli aggiornamenti di uno stesso evento (`meta["event_key"]`).
+
+    Il primo notice di un evento passa subito. Quelli che arrivano entro
+    `window` secondi dall'ultimo inoltro restano in attesa: allo scadere della
+    finestra viene inoltrato solo il più recente. Un notice di rango inferiore
+    (`meta["event_rank"]`) a quello già inoltrato viene scartato. Gli elementi
+    sostituiti o scartati vengono rilasciati con `release_item`.
+    """
+
+    def __init__(self, window: float, emit: Callable[[Any], None], ttl: float = 6 * 3600):
+        self.window = window
+        self.emit = emit
+        self.ttl = ttl
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def submit(self, item: Tuple[str, Dict[str, Any]]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Restituisce l'elemento da inoltrare subito, oppure None se è stato trattenuto o scartato."""
+        key = item[1].get("event_key")
+        if not key:
+            return item
+        rank = item[1].get("event_rank", 0)
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            st = self._state.get(key)
+            if st is None:
+                self._state[key] = {"last": now, "rank": rank, "pending": None, "timer": None}
+                return item
+            pending = st["pending"]
+            if rank < st["rank"] or (pending is not None and rank < pending[1].get("event_rank", 0)):
+                self.coalesced += 1
+                release_item(item)
+                return None
+            if st["timer"] is None and now - st["last"] >= self.window:
+                st["last"], st["rank"] = now, rank
+                return item
+            if pending is not None:
+                self.coalesced += 1
+                release_item(pending)
+            st["pending"] = item
+            if st["timer"] is None:
+                st["timer"] = threading.Timer(max(0.0, st["last"] + self.window - now), self._flush, args=(key,))
+                st["timer"].daemon = True
+                st["timer"].start()
+        return None
+
+    def _flush(self, key: str) -> None:
+        with self._lock:
+            st = self._state.get(key)
+            if st is None:
+                return
+            item, st["pending"], st["timer"] = st["pending"], None, None
+            if item is not None:
+                st["last"], st["rank"] = time.monotonic(), item[1].get("event_rank", 0)
+        if item is not None:
+            self.emit(item)
+
+    def _prune(self, now: float) -> None:
+        # chiamato sempre con il lock acquisito
+        stale = [k for k, st in self._state.items() if st["timer"] is None and now - st["last"] > self.ttl]
+        for k in stale:
+            del self._state[k]
+
+def parse_message(topic: str, value: bytes) -> Tuple[Optional[str], Dict[str, Any]]:
+    decode = decoder_for(topic)
+    if decode is None:
+        return None, {}
+    text_caption, meta = decode(value)
+
+    if text_caption and meta.get("type") == "gw" and meta.get("skip"):
+        text_caption = None  # filtra preliminari
+    return text_caption, meta
+
+def release_item(item: Tuple) -> None:
+    """Conferma l'offset Kafka di un elemento che esce dalla pipeline (inoltrato o scartato)."""
+    token = item[-1] if item else None
+    if isinstance(token, OffsetToken):
+        token.done()
+
+def dead_letter_item(stage: str, item: Tuple, err: Exception) -> None:
+    """Elemento fallito a ogni tentativo: salva il messaggio Kafka originale, poi ne conferma l'offset.
+
+    Se nemmeno il salvataggio riesce l'offset resta in sospeso: al riavvio il
+    messaggio verrà riletto da Kafka.
+    """
+    token = item[-1] if item else None
+    if not isinstance(token, OffsetToken):
+        return
+    try:
+        STORE.dead_letter(token.tp[0], token.tp[1], token.offset, token.value, stage, str(err))
+    except Exception as e:
+        print(f"[Pipeline] dead letter non salvata, {token.tp[0]}@{token.offset} resta in sospeso: {e}")
+        return
+    print(f"[Pipeline] {stage}: {token.tp[0]}@{token.offset} spostato nelle dead letter ({err})")
+    token.done()
+
+def _parse_stage(item: Tuple[str, bytes, "OffsetToken"]):
+    global LAST_ALERT
+    topic, value, token = item
+    text_caption, meta = parse_message(topic, value)
+    if not text_caption:
+        token.done()
+        return None
+    LAST_ALERT = (text_caption, meta)
+    merged = EVENTS.correlate(text_caption, meta)
+    if merged is None:
+        token.done()
+        return None
+    return COALESCER.submit(merged + (token,))
+
+def _render_stage(item: Tuple[str, Dict[str, Any], "OffsetToken"]):
+    caption, meta, token = item
+    if HAVE_HEALPY and SUBSCRIBERS.has_sky_filters():
+        meta = dict(meta, region_pixels=alert_skymap_region(meta))
+    return caption, meta, build_alert_image(caption, meta), token
+
+def _fanout_stage(item: Tuple[str, Dict[str, Any], bytes, "OffsetToken"]):
+    caption, meta, img, token = item
+    enqueue_alert(caption, meta, img)
+    token.done()   # consegne in outbox (persistente): ora l'offset si può confermare
+    return None
+
+PARSE_STAGE = Stage("parse", _parse_stage, PARSE_WORKERS, dead_letter=dead_letter_item)
+RENDER_STAGE = Stage("render", _render_stage, RENDER_WORKERS, dead_letter=dead_letter_item)
+FANOUT_STAGE = Stage("fanout", _fanout_stage, FANOUT_STAGE_WORKERS, dead_letter=dead_letter_item)
+PARSE_STAGE.next = RENDER_STAGE
+RENDER_STAGE.next = FANOUT_STAGE
+PIPELINE = (PARSE_STAGE, RENDER_STAGE, FANOUT_STAGE)
+COALESCER = Coalescer(COALESCE_SEC, RENDER_STAGE.put)
+EVENTS = EventIndex()
+
+def start_pipeline() -> None:
+    for stage in PIPELINE:
+        stage.start()
+
+def pipeline_stats() -> Dict[str, Dict[str, Any]]:
+    return {stage.name: stage.stats() for stage in PIPELINE}
 
 # ==========================
 # KAFKA CONSUMER THREAD
 # ==========================
+CONSUME_BATCH = max(1, int(os.getenv("GCN_BOT_CONSUME_BATCH", "100")))   # messaggi per consume()
+CONSUME_TIMEOUT = 1.0
+OFFSET_COMMIT_SEC = 2.0   # intervallo minimo tra due commit degli offset
+
+class OffsetToken:
+    """Un messaggio Kafka in lavorazione; `done()` lo segna come completato (idempotente).
+
+    `epoch` è il numero di assegnazione della partizione al momento della
+    lettura; `value` serve solo per l'eventuale dead letter.
+    """
+
+    __slots__ = ("tracker", "tp", "offset", "epoch", "value", "_done")
+
+    def __init__(self, tracker: "OffsetTracker", tp: Tuple[str, int], offset: int, epoch: int, value: bytes):
+        self.tracker = tracker
+        self.tp = tp
+        self.offset = offset
+        self.epoch = epoch
+        self.value = value
+        self._done = False
+
+    def done(self) -> None:
+        if not self._done:
+            self._done = True
+            self.tracker._complete(self)
+
+class OffsetTracker:
+    """Offset da committare su Kafka, per (topic, partizione).
+
+    Si può confermare solo fino al primo messaggio ancora in lavorazione:
+    un messaggio concluso dopo uno più lento resta coperto finché anche
+    quello non esce dalla pipeline (consegna almeno una volta). Ogni revoca
+    di una partizione ne incrementa l'epoca: i token letti prima vengono ignorati.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight: Dict[Tuple[str, int], Set[int]] = {}
+        self._next: Dict[Tuple[str, int], int] = {}        # offset dopo l'ultimo letto
+        self._committed: Dict[Tuple[str, int], int] = {}
+        self._epochs: Dict[Tuple[str, int], int] = {}
+
+    def track(self, topic: str, partition: int, offset: int, value: bytes = b"") -> OffsetToken:
+        tp = (topic, partition)
+        with self._lock:
+            self._inflight.setdefault(tp, set()).add(offset)
+            self._next[tp] = max(self._next.get(tp, 0), offset + 1)
+            epoch = self._epochs.get(tp, 0)
+        return OffsetToken(self, tp, offset, epoch, value)
+
+    def _complete(self, token: OffsetToken) -> None:
+        with self._lock:
+            if token.epoch != self._epochs.get(token.tp, 0):
+                return   # letto prima di una revoca: la partizione non è più (o non più così) nostra
+            inflight = self._inflight.get(token.tp)
+            if inflight is not None:
+                inflight.discard(token.offset)
+
+    def committable(self) -> List[Tuple[str, int, int]]:
+        """(topic, partizione, offset) avanzati dall'ultimo commit; offset = prossimo da leggere."""
+        out = []
+        with self._lock:
+            for tp, nxt in self._next.items():
+                inflight = self._inflight.get(tp)
+                pos = min(inflight) if inflight else nxt
+                if pos > self._committed.get(tp, -1):
+                    out.append((tp[0], tp[1], pos))
+        return out
+
+    def mark_committed(self, offsets: List[Tuple[str, int, int]]) -> None:
+        with self._lock:
+            for topic, partition, pos in offsets:
+                tp = (topic, partition)
+                self._committed[tp] = max(self._committed.get(tp, -1), pos)
+
+    def forget(self, partitions: List[Tuple[str, int]]) -> None:
+        """Partizioni revocate dal gruppo: le elaborazioni in corso non vanno più confermate da qui."""
+        with self._lock:
+            for tp in partitions:
+                self._inflight.pop(tp, None)
+                self._next.pop(tp, None)
+                self._committed.pop(tp, None)
+                self._epochs[tp] = self._epochs.get(tp, 0) + 1
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(s) for s in self._inflight.values())
+
+OFFSETS = OffsetTracker()
+
+def _on_commit(err, partitions) -> None:
+    """Esito di un commit (callback di librdkafka): registra solo gli offset accettati dal broker."""
+    if err is not None:
+        print("[GCN] commit offset fallito:", err)
+        return
+    ok = [(p.topic, p.partition, p.offset) for p in partitions or [] if p.error is None and p.offset >= 0]
+    if len(ok) < len(partitions or []):
+        print("[GCN] commit offset parziale:", [str(p.error) for p in partitions if p.error is not None])
+    OFFSETS.mark_committed(ok)
+
+def commit_offsets(consumer, asynchronous: bool = True) -> None:
+    offsets = OFFSETS.committable()
+    if not offsets:
+        return
+    try:
+        result = consumer.commit(offsets=[TopicPartition(t, p, o) for t, p, o in offsets],
+                                 asynchronous=asynchronous)
+        if not asynchronous:
+            _on_commit(None, result)
+    except Exception as e:
+        # es. nessun offset da confermare o partizione revocata: riprovo al giro successivo
+        print("[GCN] commit offset fallito:", e)
+
 def consumer_loop():
-    global LAST_ALERT
-    seen: Dict[str, int] = load_json(SEEN_FILE, {})
-    cold_start = not bool(seen)  # <-- se non ho stato locale, evito replay al primo giro
+    """Stadio di ingest: legge da Kafka a blocchi e passa i messaggi alla pipeline.
 
+    Gli offset sono confermati sul broker solo quando il messaggio è uscito
+    dalla pipeline (consegne già in outbox, oppure scartato): dopo un crash
+    il gruppo riparte dall'ultimo offset confermato, senza stato locale.
+    """
     consumer = Consumer(
         config={
             "group.id": "gcn2telegram_plus",
-            "auto.offset.reset": "latest",   # parte da tail
-            "enable.auto.commit": True,
+            "auto.offset.reset": "latest",   # gruppo nuovo: parte da tail, niente replay
+            "enable.auto.commit": False,     # commit manuale, dopo la consegna in outbox
+            # i topic hanno una sola partizione: con "range" finirebbero tutti sul primo worker
+            "partition.assignment.strategy": "roundrobin",
+            "on_commit": _on_commit,         # offset registrati come confermati solo a commit riuscito
             "message.max.bytes": 20 * 1024 * 1024,
         },
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET,
         domain="gcn.nasa.gov",
     )
-    consumer.subscribe(TOPICS)
+    def on_revoke(c, partitions):
+        commit_offsets(c, asynchronous=False)
+        OFFSETS.forget([(p.topic, p.partition) for p in partitions])
+
+    consumer.subscribe(TOPICS, on_revoke=on_revoke)
 
     print("[GCN] Subscribed to topics:")
     for t in TOPICS:
         print("  -", t)
 
-    last_persist = time.time()
+    last_commit = time.monotonic()
     while True:
         try:
-            for msg in consumer.consume(timeout=1):
+            for msg in consumer.consume(num_messages=CONSUME_BATCH, timeout=CONSUME_TIMEOUT):
                 if msg is None:
                     continue
                 if msg.error():
@@ -681,53 +3031,13 @@ def consumer_loop():
                     continue
 
                 topic = msg.topic() or ""
-                offset = int(msg.offset() or 0)
-
-                # --- Bootstrap per primo avvio (evita replay) ---
-                if cold_start and topic not in seen:
-                    seen[topic] = offset
-                    # salvo subito per sicurezza e NON invio nulla
-                    save_json(SEEN_FILE, seen)
-                    continue
-
-                last_seen = int(seen.get(topic, -1))
-                if offset <= last_seen:
-                    continue
-
                 value = msg.value() or b""
-                text_caption: Optional[str] = None
-                meta: Dict[str, Any] = {}
-
-                obj = try_load_json(value)
-                if isinstance(obj, dict):
-                    if topic.startswith("igwn.gwalert"):
-                        text_caption, meta = parse_igwn_json(obj)
-                    elif topic.startswith("gcn.notices.swift.bat.guano"):
-                        text_caption, meta = parse_swift_guano_json(obj)
-                    else:
-                        text_caption, meta = None, {}
-                else:
-                    txt = value.decode("utf-8", errors="replace")
-                    if "FERMI_GBM" in topic.upper():
-                        text_caption, meta = parse_fermi_text(txt)
-                    else:
-                        text_caption, meta = None, {}
-
-                if text_caption and meta.get("type") == "gw" and meta.get("skip"):
-                    text_caption = None  # filtra preliminari
-
-                if text_caption:
-                    LAST_ALERT = (text_caption, meta)
-                    build_and_send_with_image(text_caption, meta)
+                token = OFFSETS.track(topic, msg.partition(), int(msg.offset()), value)
+                PARSE_STAGE.put((topic, value, token))
 
-                seen[topic] = offset
-                if time.time() - last_persist > 5:
-                    save_json(SEEN_FILE, seen)
-                    last_persist = time.time()
-
-            # una volta popolato "seen" per tutti i topic, tolgo il flag
-            if cold_start and all(t in seen for t in TOPICS):
-                cold_start = False
+            if time.monotonic() - last_commit >= OFFSET_COMMIT_SEC:
+                commit_offsets(consumer)
+                last_commit = time.monotonic()
 
         except Exception as e:
             print("[GCN] consumer_loop exception:", e)
@@ -737,7 +3047,12 @@ def consumer_loop():
 # CIRCULARS POLLER THREAD
 # ==========================
 CIRCULARS_URL = "https://gcn.nasa.gov/circulars"
-CIRC_POLL_SEC = 120
+CIRCULAR_JSON_URL = "https://gcn.nasa.gov/circulars/{cid}.json"
+CIRC_POLL_SEC = 10          # controllo del prossimo ID (una richiesta piccola, 404 se non c'è)
+CIRC_INDEX_POLL_SEC = 120   # rilettura condizionale della pagina indice, per ID saltati
+CIRC_FETCH_WORKERS = 4      # download paralleli di circular durante una raffica
+
+_CIRC_POOL = ThreadPoolExecutor(max_workers=CIRC_FETCH_WORKERS, thread_name_prefix="circ-fetch")
 
 def parse_circulars_page(html: str) -> List[Tuple[int, str, str]]:
     results: List[Tuple[int, str, str]] = []
@@ -754,66 +3069,216 @@ def parse_circulars_page(html: str) -> List[Tuple[int, str, str]]:
     out.sort(key=lambda x: x[0], reverse=True)
     return out[:50]
 
+class CircularsIndex:
+    """Pagina indice delle circular letta con GET condizionale.
+
+    Conserva ETag e Last-Modified dell'ultima risposta: se la pagina non è
+    cambiata il server risponde 304 e `fetch()` restituisce None senza
+    scaricare né analizzare l'HTML.
+    """
+
+    def __init__(self):
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+
+    def fetch(self) -> Optional[List[Tuple[int, str, str]]]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        r = HTTP_GCN.get(CIRCULARS_URL, timeout=30, headers=headers)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        self.etag = r.headers.get("ETag")
+        self.last_modified = r.headers.get("Last-Modified")
+        return parse_circulars_page(r.text) if r.text else []
+
+def fetch_circular_json(cid: int) -> Optional[Dict[str, Any]]:
+    """Singola circular dall'endpoint JSON (None se non ancora pubblicata)."""
+    r = HTTP_GCN.get(CIRCULAR_JSON_URL.format(cid=cid), timeout=30)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    obj = r.json()
+    return obj if isinstance(obj, dict) else None
+
+def format_circular_position(ra_deg: Optional[float], dec_deg: Optional[float], unc: Optional[float],
+                             ra_sex: Optional[str], dec_sex: Optional[str]) -> str:
+    if ra_deg is None or dec_deg is None:
+        return ""
+    extra_lines = [
+        "📍 <b>Posizione (J2000)</b>",
+        f"• RA: {ra_sex}  ({ra_deg:.5f}°)",
+        f"• Dec: {dec_sex} ({dec_deg:.5f}°)"
+    ]
+    if unc is not None:
+        extra_lines.append(f"• Uncertainty: ±{unc:.2f}\"")
+    return "\n" + "\n".join(extra_lines)
+
+class CircularStore:
+    """Archivio locale delle circular già viste (tabella `circulars` in DB_FILE).
+
+    Per ogni ID conserva titolo, URL, testo e coordinate estratte, così i
+    comandi possono rispondere senza riscaricare e rianalizzare la pagina.
+    """
+
+    FIELDS = ("id", "title", "url", "body", "ra", "dec", "unc", "ra_sex", "dec_sex", "fetched")
+
+    def __init__(self):
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        # chiamato sempre con il lock acquisito
+        if self._conn is None:
+            self._conn = db_connect()
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS circulars (
+                    id INTEGER PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    body TEXT,
+                    ra REAL,
+                    dec REAL,
+                    unc REAL,
+                    ra_sex TEXT,
+                    dec_sex TEXT,
+                    fetched REAL NOT NULL
+                )
+            """)
+        return self._conn
+
+    def put(self, rec: Dict[str, Any]) -> None:
+        row = dict(rec, fetched=time.time())
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    f"INSERT OR REPLACE INTO circulars ({', '.join(self.FIELDS)}) "
+                    f"VALUES ({', '.join('?' * len(self.FIELDS))})",
+                    [row.get(k) for k in self.FIELDS],
+                )
+
+    def _one(self, where: str, args: Tuple = ()) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db().execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM circulars {where} LIMIT 1", args
+            ).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def get(self, cid: int) -> Optional[Dict[str, Any]]:
+        return self._one("WHERE id = ?", (cid,))
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        return self._one("ORDER BY id DESC")
+
+CIRCULAR_STORE = CircularStore()
+
+def load_circular(cid: int, title: str, url: str, body: Optional[str] = None) -> Dict[str, Any]:
+    """Testo e coordinate di una circular; senza `body` lo legge dall'endpoint JSON. Il risultato va in archivio.
+
+    Se il JSON non è disponibile le coordinate vengono dalla pagina HTML, ma il
+    testo non si archivia (la pagina contiene anche menu e piè di pagina).
+    """
+    if not body:
+        try:
+            body = (fetch_circular_json(cid) or {}).get("body") or None
+        except Exception as e:
+            print(f"[Circulars] JSON #{cid} non disponibile: {e}")
+    if body:
+        coords = parse_ra_dec_from_text(body)
+    else:
+        html = fetch_circular_body(url)
+        coords = coords_from_circular_html(html) if html else (None,) * 5
+    rec = dict(zip(("ra", "dec", "unc", "ra_sex", "dec_sex"), coords), id=cid, title=title, url=url, body=body)
+    CIRCULAR_STORE.put(rec)
+    return rec
+
+def format_circular(rec: Dict[str, Any]) -> str:
+    extra = format_circular_position(rec["ra"], rec["dec"], rec["unc"], rec["ra_sex"], rec["dec_sex"])
+    return f"📝 <b>GCN Circular #{rec['id']}</b>\n{rec['title']}\n🔗 {rec['url']}{extra}"
+
 def _bootstrap_circulars_state_if_needed():
     """Se è il primo avvio (last_id=0), inizializza allo stato corrente SENZA inviare nulla."""
-    state = load_json(CIRC_FILE, {"last_id": 0})
-    last_id = int(state.get("last_id", 0))
+    last_id = int(STORE.get_kv("circulars_last_id", 0))
     if last_id != 0:
         return
     try:
-        r = requests.get(CIRCULARS_URL, timeout=30)
+        r = HTTP_GCN.get(CIRCULARS_URL, timeout=30)
         if r.status_code == 200 and r.text:
             items = parse_circulars_page(r.text)
             if items:
                 current_max = max(cid for cid, _, _ in items)
-                save_json(CIRC_FILE, {"last_id": current_max})
+                STORE.set_kv("circulars_last_id", current_max)
                 #print(f"[Circulars] Bootstrap: impostato last_id={current_max} (nessun invio)")
     except Exception as e:
         print(f"[Circulars] bootstrap errore: {e}")
 
-def broadcast_circular(cid: int, title: str, url: str):
-    ra_deg, dec_deg, unc, ra_sex, dec_sex = extract_coords_from_circular(url)
-    extra = ""
-    if ra_deg is not None and dec_deg is not None:
-        extra_lines = [
-            "📍 <b>Posizione (J2000)</b>",
-            f"• RA: {ra_sex}  ({ra_deg:.5f}°)",
-            f"• Dec: {dec_sex} ({dec_deg:.5f}°)"
-        ]
-        if unc is not None:
-            extra_lines.append(f"• Uncertainty: ±{unc:.2f}\"")
-        extra = "\n" + "\n".join(extra_lines)
-
-    text = f"📝 <b>GCN Circular #{cid}</b>\n{title}\n🔗 {url}{extra}"
-    subs = list_subscribers()
-    for k, v in subs.items():
-        chat_id = int(k)
-        entry = get_user_entry(chat_id)
-        if entry.get("muted", False):
-            continue
-        filters = entry.get("filters", default_filters())
-        if not filters.get("circulars", False):
-            continue
-        tg_send_text(chat_id, text)
+def broadcast_circular(rec: Dict[str, Any]):
+    OUTBOX.enqueue_text(SUBSCRIBERS.recipients("circulars"), format_circular(rec), label=f"Circular #{rec['id']}")
+
+def broadcast_circulars_in_order(items: List[Tuple[int, str, str]], on_sent: Callable[[int], None]) -> None:
+    """Prepara le circular in parallelo e le invia in ordine di ID appena pronte.
+
+    Ogni circular parte non appena sono pronte lei e tutte quelle con ID minore.
+    """
+    futures = [(cid, _CIRC_POOL.submit(load_circular, cid, title, url))
+               for cid, title, url in sorted(items, key=lambda x: x[0])]
+    for cid, fut in futures:
+        broadcast_circular(fut.result())
+        on_sent(cid)
+
+def probe_new_circulars(last_id: int, on_sent: Callable[[int], None]) -> int:
+    """Scarica le circular successive a `last_id` dall'endpoint JSON.
+
+    In regime normale basta una richiesta; quando arriva una raffica la
+    finestra di ID richiesti in parallelo raddoppia fino a CIRC_FETCH_WORKERS.
+    """
+    window = 1
+    while True:
+        ids = range(last_id + 1, last_id + 1 + window)
+        futures = [(cid, _CIRC_POOL.submit(fetch_circular_json, cid)) for cid in ids]
+        for cid, fut in futures:
+            obj = fut.result()
+            if obj is None:
+                return last_id
+            broadcast_circular(load_circular(cid, html_escape(str(obj.get("subject") or "")),
+                                             f"{CIRCULARS_URL}/{cid}", body=obj.get("body")))
+            last_id = cid
+            on_sent(cid)
+        window = min(window * 2, CIRC_FETCH_WORKERS)
 
 def circulars_loop():
+    LEADER.wait_leader()   # in cluster il poller gira solo sul leader
     # Bootstrap su primo avvio: non inviare arretrati
     _bootstrap_circulars_state_if_needed()
 
-    state = load_json(CIRC_FILE, {"last_id": 0})
-    last_id = int(state.get("last_id", 0))
+    last_id = int(STORE.get_kv("circulars_last_id", 0))
+    index = CircularsIndex()
+    last_index = 0.0
+
+    def _sent(cid: int):
+        nonlocal last_id
+        last_id = max(last_id, cid)
+        STORE.set_kv("circulars_last_id", last_id)
+
     print("[GCN] Circulars poller attivo.")
     while True:
+        if not LEADER.is_leader():
+            LEADER.wait_leader()
+            last_id = max(last_id, int(STORE.get_kv("circulars_last_id", 0)))   # avanzato dal leader precedente
         try:
-            r = requests.get(CIRCULARS_URL, timeout=30)
-            if r.status_code == 200 and r.text:
-                items = parse_circulars_page(r.text)
-                new_items = [it for it in items if it[0] > last_id]
-                for (cid, title, url) in sorted(new_items, key=lambda x: x[0]):
-                    broadcast_circular(cid, title, url)
-                    last_id = max(last_id, cid)
-                if new_items:
-                    save_json(CIRC_FILE, {"last_id": last_id})
+            # 1) solo gli ID successivi a last_id, dall'endpoint JSON
+            probe_new_circulars(last_id, _sent)
+
+            # 2) ogni tanto l'indice (condizionale): recupera eventuali ID saltati
+            if time.time() - last_index >= CIRC_INDEX_POLL_SEC:
+                last_index = time.time()
+                items = index.fetch()
+                new_items = [it for it in (items or []) if it[0] > last_id]
+                broadcast_circulars_in_order(new_items, _sent)
         except Exception as e:
             print(f"[Circulars] errore poll: {e}")
         time.sleep(CIRC_POLL_SEC)
@@ -821,7 +3286,7 @@ def circulars_loop():
 # ======= Test – recupera l'ultima circular pubblicata =======
 def fetch_latest_circular() -> Optional[Tuple[int, str, str]]:
     try:
-        r = requests.get(CIRCULARS_URL, timeout=30)
+        r = HTTP_GCN.get(CIRCULARS_URL, timeout=30)
         r.raise_for_status()
         items = parse_circulars_page(r.text)
         if items:
@@ -830,6 +3295,18 @@ def fetch_latest_circular() -> Optional[Tuple[int, str, str]]:
         print(f"[TestCircular] errore fetch: {e}")
     return None
 
+def latest_circular_test_text() -> str:
+    """Risposta a /testriceviultimagcn: dall'archivio locale, dalla rete solo se è vuoto."""
+    rec = CIRCULAR_STORE.latest()
+    if rec is None:
+        latest = fetch_latest_circular()
+        if latest:
+            rec = load_circular(*latest)
+    if rec is None:
+        return "ℹ️ Nessuna circular trovata al momento. Riprova tra poco."
+    extra = format_circular_position(rec["ra"], rec["dec"], rec["unc"], rec["ra_sex"], rec["dec_sex"])
+    return f"🧪 <b>Test</b>: ultima GCN Circular\n📝 <b>#{rec['id']}</b> — {rec['title']}\n🔗 {rec['url']}{extra}"
+
 # ==========================
 # UI / COMANDI TELEGRAM
 # ==========================
@@ -838,6 +3315,11 @@ HELP_TEXT = (
     "• Apri il <b>menu</b> con <code>/menu</code> (trovi le azioni principali).\n"
     "• Con <code>/filtri</code> imposti le sorgenti: 🌊 GW, 🛰️ Swift/Fermi (GRB), 📝 Circulars.\n"
     "• <code>/attivaricezione</code> / <code>/disattivaricezione</code> avviano/sospendono gli alert.\n\n"
+    "🔭 <b>Filtri sul cielo</b> (per GW, Swift e Fermi; <code>off</code> per rimuoverli):\n"
+    "• <code>/regione RA Dec raggio</code> – solo eventi entro il cerchio (gradi)\n"
+    "• <code>/declinazione min max</code> – solo eventi nella fascia di declinazione\n"
+    "• <code>/maxfar Hz</code> – solo GW con FAR inferiore alla soglia (es. <code>1e-7</code>)\n"
+    "• <code>/maxerr gradi</code> – solo GRB con errore di posizione inferiore\n\n"
     "Di default ricevi <b>solo i trigger GRB Swift/Fermi</b> (GW e Circulars OFF).\n"
 )
 
@@ -885,14 +3367,402 @@ def render_filters_text(chat_id: int) -> str:
         f"• 🌊 GW LIGO/Virgo: <b>{'ON' if f.get('gw', False) else 'OFF'}</b>",
         f"• 🛰️ Swift/Fermi (solo GRB): <b>{'ON' if f.get('swiftfermi', True) else 'OFF'}</b>",
         f"• 📝 GCN Circulars: <b>{'ON' if f.get('circulars', False) else 'OFF'}</b>",
-        "",
-        "Tocca i pulsanti per attivare/disattivare."
     ]
+    sky = get_user_entry(chat_id).get("sky") or {}
+    if sky:
+        lines.append("🔭 <b>Filtri sul cielo</b>")
+        if sky.get("region"):
+            r = sky["region"]
+            lines.append(f"• Regione: RA {r['ra']:.2f}°, Dec {r['dec']:+.2f}°, raggio {r['radius']:.1f}°")
+        if sky.get("dec_band"):
+            lines.append(f"• Declinazione: da {sky['dec_band'][0]:+.1f}° a {sky['dec_band'][1]:+.1f}°")
+        if sky.get("max_far") is not None:
+            lines.append(f"• FAR massimo: {sky['max_far']:.3g} Hz")
+        if sky.get("max_err") is not None:
+            lines.append(f"• Errore massimo: {sky['max_err']:.2f}°")
+    lines += ["", "Tocca i pulsanti per attivare/disattivare."]
     return "\n".join(lines)
 
+SKY_COMMANDS = {
+    "/regione": ("region", 3, "<code>/regione RA Dec raggio</code> (gradi), es. <code>/regione 180 -30 40</code>"),
+    "/declinazione": ("dec_band", 2, "<code>/declinazione min max</code>, es. <code>/declinazione -90 20</code>"),
+    "/maxfar": ("max_far", 1, "<code>/maxfar Hz</code>, es. <code>/maxfar 1e-7</code>"),
+    "/maxerr": ("max_err", 1, "<code>/maxerr gradi</code>, es. <code>/maxerr 5</code>"),
+}
+
+def handle_sky_command(chat_id: int, cmd: str, args: List[str]) -> str:
+    """Imposta un filtro sul cielo e restituisce il testo di risposta."""
+    key, nargs, usage = SKY_COMMANDS[cmd]
+    if len(args) == 1 and args[0].lower() == "off":
+        SUBSCRIBERS.set_sky(chat_id, **{key: None})
+        return "✅ Filtro rimosso.\n\n" + render_filters_text(chat_id)
+    try:
+        vals = [float(a.replace(",", ".")) for a in args]
+    except ValueError:
+        vals = []
+    ok = len(vals) == nargs and all(math.isfinite(v) for v in vals)
+    if ok and key == "region":
+        ra, dec, radius = vals
+        ok = 0 <= ra < 360 and -90 <= dec <= 90 and 0 < radius <= 180
+        value: Any = {"ra": ra, "dec": dec, "radius": radius}
+    elif ok and key == "dec_band":
+        ok = -90 <= vals[0] < vals[1] <= 90
+        value = vals
+    elif ok:
+        ok = vals[0] > 0
+        value = vals[0]
+    if not ok:
+        return f"ℹ️ Uso: {usage}\nPer rimuovere il filtro: <code>{cmd} off</code>"
+    SUBSCRIBERS.set_sky(chat_id, **{key: value})
+    return "✅ Filtro aggiornato.\n\n" + render_filters_text(chat_id)
+
+def render_stats_text() -> str:
+    lines = ["📊 <b>Statistiche</b>", "", "<b>HTTP pool</b>"]
+    for name, st in http_pool_stats().items():
+        lines.append(
+            f"• {name}: {st['requests']} req, {st['errors']} errori, "
+            f"{st['connections']} conn., {st['avg_ms']:.0f} ms medi"
+        )
+    lines += ["", "<b>Pipeline</b>"]
+    for name, st in pipeline_stats().items():
+        lines.append(
+            f"• {name}: coda {st['depth']}, {st['processed']} elaborati, {st['errors']} errori, "
+            f"attesa {st['wait_ms']:.0f} ms, lavoro {st['run_ms']:.0f} ms"
+        )
+    lines.append(f"• aggiornamenti raggruppati: {COALESCER.coalesced} | eventi uniti: {EVENTS.merged}")
+    lines.append(f"• messaggi Kafka in lavorazione (offset non confermati): {OFFSETS.pending()}")
+    cache = CACHE.stats()
+    lines += ["", "<b>Cache</b>",
+              f"• disco: {cache['disk_bytes'] / 2**20:.1f} MiB | RAM: {cache['memory_bytes'] / 2**20:.1f} MiB"]
+    for ns, (hit, miss) in sorted(cache["counters"].items()):
+        lines.append(f"• {ns}: {hit} hit / {miss} miss")
+    lines += ["", "<b>Outbox</b>",
+              f"• in coda: {OUTBOX.pending()} | consegnati: {OUTBOX.delivered} | "
+              f"ritentati: {OUTBOX.retried} | scartati: {OUTBOX.dropped}"]
+    if FANOUT.last_broadcast:
+        label, ok, total, elapsed = FANOUT.last_broadcast
+        lines.append(f"• ultimo broadcast: {html_escape(label)} → {ok}/{total} in {elapsed:.2f}s")
+    if WORKER_COUNT > 1:
+        lines += ["", "<b>Cluster</b>",
+                  f"• {WORKER_COUNT} worker, questo è il n. {WORKER_INDEX} (leader) | "
+                  f"{TG_GLOBAL_RATE:.1f} msg/s per worker"]
+    return "\n".join(lines)
+
+COMMAND_SHARDS = 4                          # thread per i comandi lenti
+SLOW_COMMANDS = {"/testriceviultimagcn"}    # comandi che possono attendere la rete
+
+class ChatExecutor:
+    """Esecuzione in background dei comandi, in ordine per chat.
+
+    Ogni chat è assegnata sempre allo stesso shard (un thread con la propria
+    coda), quindi i comandi di una chat restano ordinati mentre chat diverse
+    procedono in parallelo. `busy()` indica se una chat ha ancora comandi in
+    sospeso: in quel caso anche i comandi veloci passano dallo shard.
+    """
+
+    def __init__(self, shards: int = COMMAND_SHARDS):
+        self.queues: List[queue.Queue] = [queue.Queue() for _ in range(shards)]
+        self._pending: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _start(self) -> None:
+        # chiamato sempre con il lock acquisito
+        if self._started:
+            return
+        self._started = True
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._worker, args=(q,), name=f"cmd-{i}", daemon=True).start()
+
+    def busy(self, chat_id: int) -> bool:
+        with self._lock:
+            return chat_id in self._pending
+
+    def submit(self, chat_id: int, fn: Callable[..., None], *args) -> None:
+        with self._lock:
+            self._start()
+            self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        self.queues[hash(chat_id) % len(self.queues)].put((chat_id, fn, args))
+
+    def _worker(self, q: queue.Queue) -> None:
+        while True:
+            chat_id, fn, args = q.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[cmd] errore handler chat {chat_id}: {e}")
+            finally:
+                with self._lock:
+                    n = self._pending.get(chat_id, 1) - 1
+                    if n > 0:
+                        self._pending[chat_id] = n
+                    else:
+                        self._pending.pop(chat_id, None)
+
+COMMANDS = ChatExecutor()
+
+def handle_callback(cb: Dict[str, Any]):
+    cb_id = cb.get("id")
+    from_id = cb.get("from", {}).get("id")
+    data_cb = cb.get("data", "") or ""
+    msg = cb.get("message", {}) or {}
+    chat_id = msg.get("chat", {}).get("id")
+    mid = msg.get("message_id")
+
+    if data_cb.startswith("cmd:") and from_id and chat_id and mid:
+        cmd = data_cb[4:]
+
+        if cmd == "/menu":
+            tg_answer_callback_query(cb_id, "")
+            tg_edit_message_text(chat_id, mid, MAIN_MENU_TEXT, reply_markup=keyboard_main_menu()); return
+        if cmd == "/impostazioni":
+            tg_answer_callback_query(cb_id, "")
+            tg_edit_message_text(chat_id, mid, SUBMENU_TEXT, reply_markup=keyboard_submenu()); return
+        if cmd == "/testriceviultimagcn":
+            tg_answer_callback_query(cb_id, "⏳ Recupero ultima GCN Circular…")
+            tg_send_text(chat_id, latest_circular_test_text())
+            return
+        if cmd == "/help":
+            tg_answer_callback_query(cb_id, "")
+            tg_edit_message_text(chat_id, mid, HELP_TEXT, reply_markup=keyboard_main_menu()); return
+        if cmd == "/contattaautore":
+            tg_answer_callback_query(cb_id, "")
+            tg_edit_message_text(chat_id, mid, "👤 Contatta l’autore: @antoninobrosio", reply_markup=keyboard_main_menu()); return
+        if cmd == "/attivaricezione":
+            tg_answer_callback_query(cb_id, "")
+            add_subscriber(from_id); set_muted(from_id, False)
+            tg_edit_message_text(chat_id, mid, "✅ Ricezione attivata. Riceverai gli alert secondo i filtri.", reply_markup=keyboard_submenu()); return
+        if cmd == "/disattivaricezione":
+            tg_answer_callback_query(cb_id, "")
+            add_subscriber(from_id); set_muted(from_id, True)
+            tg_edit_message_text(chat_id, mid, "🚫 Ricezione disattivata. Usa /attivaricezione per riattivare.", reply_markup=keyboard_submenu()); return
+        if cmd in ("/filtri", "/filters"):
+            tg_answer_callback_query(cb_id, "")
+            kb = keyboard_filters_inline(get_filters(from_id))
+            tg_edit_message_text(chat_id, mid, render_filters_text(from_id), reply_markup=kb); return
+        if cmd == "/status":
+            tg_answer_callback_query(cb_id, "")
+            entry = get_user_entry(from_id); muted = entry.get("muted", False)
+            text = f"ℹ️ <b>Stato</b>: {'🛑 Sospeso' if muted else '🟢 Attivo'}\n\n" + render_filters_text(from_id)
+            tg_edit_message_text(chat_id, mid, text, reply_markup=keyboard_submenu()); return
+
+        tg_answer_callback_query(cb_id, "")
+        tg_edit_message_text(chat_id, mid, MAIN_MENU_TEXT, reply_markup=keyboard_main_menu()); return
+
+    if data_cb.startswith("toggle:") and from_id and chat_id and mid:
+        key = data_cb.split(":", 1)[1]
+        f = get_filters(from_id)
+        if key == "gw":
+            set_filters(from_id, gw=not f.get("gw", False))
+        elif key == "swiftfermi":
+            set_filters(from_id, swiftfermi=not f.get("swiftfermi", True))
+        elif key == "circulars":
+            set_filters(from_id, circulars=not f.get("circulars", False))
+        tg_answer_callback_query(cb_id, "🔄 Filtri aggiornati")
+        new_text = render_filters_text(from_id)
+        new_kb = keyboard_filters_inline(get_filters(from_id))
+        tg_edit_message_text(chat_id, mid, new_text, reply_markup=new_kb)
+        return
+
+    tg_answer_callback_query(cb_id, "")
+
+def handle_message(msg: Dict[str, Any]):
+    if not msg or "text" not in msg:
+        return
+
+    chat_id = msg["chat"]["id"]
+    text = (msg["text"] or "").strip()
+    parts = text.split()
+    cmd = parts[0].lower() if parts else ""
+
+    if cmd == "/start":
+        add_subscriber(chat_id)
+        set_muted(chat_id, False)
+        tg_send_text(chat_id, WELCOME_TEXT, reply_markup=keyboard_main_menu())
+
+    elif cmd == "/menu":
+        tg_send_text(chat_id, MAIN_MENU_TEXT, reply_markup=keyboard_main_menu())
+
+    elif cmd == "/impostazioni":
+        tg_send_text(chat_id, SUBMENU_TEXT, reply_markup=keyboard_submenu())
+
+    elif cmd == "/testriceviultimagcn":
+        tg_send_text(chat_id, latest_circular_test_text())
+
+    elif cmd == "/attivaricezione":
+        add_subscriber(chat_id)
+        set_muted(chat_id, False)
+        tg_send_text(chat_id, "✅ Ricezione attivata. Riceverai gli alert secondo i filtri.", reply_markup=keyboard_submenu())
+
+    elif cmd == "/disattivaricezione":
+        add_subscriber(chat_id)
+        set_muted(chat_id, True)
+        tg_send_text(chat_id, "🚫 Ricezione disattivata. Usa /attivaricezione per riattivare.", reply_markup=keyboard_submenu())
+
+    elif cmd in ("/filtri", "/filters"):
+        add_subscriber(chat_id)
+        kb = keyboard_filters_inline(get_filters(chat_id))
+        tg_send_text(chat_id, render_filters_text(chat_id), reply_markup=kb)
+
+    elif cmd == "/status":
+        entry = get_user_entry(chat_id)
+        muted = entry.get("muted", False)
+        tg_send_text(
+            chat_id,
+            f"ℹ️ <b>Stato</b>: {'🛑 Sospeso' if muted else '🟢 Attivo'}\n\n" + render_filters_text(chat_id),
+            reply_markup=keyboard_submenu()
+        )
+
+    elif cmd == "/help":
+        tg_send_text(chat_id, HELP_TEXT, reply_markup=keyboard_main_menu())
+
+    elif cmd == "/contattaautore":
+        tg_send_text(chat_id, "👤 Contatta l’autore: @antoninobrosio", reply_markup=keyboard_main_menu())
+
+    elif cmd in SKY_COMMANDS:
+        add_subscriber(chat_id)
+        tg_send_text(chat_id, handle_sky_command(chat_id, cmd, parts[1:]), reply_markup=keyboard_submenu())
+
+    elif cmd == "/stats" and chat_id == ADMIN_CHAT_ID:
+        tg_send_text(chat_id, render_stats_text())
+
+    else:
+        tg_send_text(chat_id, "📂 Usa <b>/menu</b> per il menu principale o <b>/impostazioni</b> per le azioni.", reply_markup=keyboard_main_menu())
+
+def handle_update(upd: Dict[str, Any]):
+    if "callback_query" in upd:
+        handle_callback(upd["callback_query"])
+        return
+    msg = upd.get("message") or upd.get("edited_message")
+    if msg:
+        handle_message(msg)
+
+def _update_route(upd: Dict[str, Any]) -> Tuple[Optional[int], str]:
+    """Chat e comando di un update, per decidere dove eseguirlo."""
+    if "callback_query" in upd:
+        cb = upd["callback_query"]
+        chat_id = (cb.get("message") or {}).get("chat", {}).get("id")
+        data_cb = cb.get("data", "") or ""
+        return chat_id, data_cb[4:] if data_cb.startswith("cmd:") else ""
+    msg = upd.get("message") or upd.get("edited_message") or {}
+    parts = (msg.get("text") or "").strip().split()
+    return msg.get("chat", {}).get("id"), parts[0].lower() if parts else ""
+
+def dispatch_update(upd: Dict[str, Any]):
+    """Comandi veloci subito nel loop; quelli lenti (o di chat con lavoro in corso) nello shard della chat."""
+    chat_id, cmd = _update_route(upd)
+    if chat_id is not None and (cmd in SLOW_COMMANDS or COMMANDS.busy(chat_id)):
+        COMMANDS.submit(chat_id, handle_update, upd)
+        return
+    try:
+        handle_update(upd)
+    except Exception as e:
+        print(f"[cmd] errore handler: {e}")
+
+# ======= Webhook (opzionale) =======
+# Con GCN_BOT_WEBHOOK_URL impostato (URL pubblico HTTPS, di solito un reverse
+# proxy verso questa porta) Telegram spinge gli update e il long-polling è spento.
+WEBHOOK_URL = os.getenv("GCN_BOT_WEBHOOK_URL", "").strip()
+WEBHOOK_LISTEN = os.getenv("GCN_BOT_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("GCN_BOT_WEBHOOK_PORT") or "8443")
+WEBHOOK_SECRET = (os.getenv("GCN_BOT_WEBHOOK_SECRET")
+                  or hashlib.sha256(f"webhook:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest())
+WEBHOOK_MAX_BODY = 1 << 20
+
+# gli update ricevuti passano da un solo thread, come nel long-polling: ordine per chat garantito
+WEBHOOK_UPDATES: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+_webhook_dispatcher: Optional[threading.Thread] = None
+
+def _webhook_dispatch_loop():
+    while True:
+        upd = WEBHOOK_UPDATES.get()
+        try:
+            dispatch_update(upd)
+        except Exception as e:
+            print(f"[cmd] errore dispatch webhook: {e}")
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    path_expected = "/"
+
+    def _reply(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != self.path_expected:
+            self._reply(404); return
+        if self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            self._reply(403); return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self._reply(400); return
+        try:
+            upd = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._reply(400); return
+        # risposta immediata: Telegram non aspetta l'esecuzione del comando
+        self._reply(200)
+        if isinstance(upd, dict):
+            WEBHOOK_UPDATES.put(upd)
+
+    def do_GET(self):
+        self._reply(200 if self.path == "/healthz" else 404)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_webhook_server():
+    global _webhook_dispatcher
+    _WebhookHandler.path_expected = urlparse(WEBHOOK_URL).path or "/"
+    if _webhook_dispatcher is None:
+        _webhook_dispatcher = threading.Thread(target=_webhook_dispatch_loop, name="webhook-dispatch", daemon=True)
+        _webhook_dispatcher.start()
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), _WebhookHandler)
+    server.daemon_threads = True
+    while not tg_set_webhook(WEBHOOK_URL, WEBHOOK_SECRET):
+        time.sleep(10)
+    print(f"[Telegram] Webhook attivo su {WEBHOOK_LISTEN}:{WEBHOOK_PORT} → {WEBHOOK_URL}")
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    LEADER.wait_lost()   # un altro worker è diventato leader: libera la porta
+    server.shutdown()
+    server.server_close()
+
+def poll_updates():
+    """Long-polling di getUpdates finché questo processo è leader.
+
+    L'offset confermato è salvato nello store: un nuovo leader (o un riavvio)
+    riparte da lì invece di rielaborare l'ultimo blocco di update.
+    """
+    tg_delete_webhook()
+    update_offset = STORE.get_kv("tg_update_offset")
+    while LEADER.is_leader():
+        data = tg_get_updates(update_offset)
+        if not data.get("ok", False):
+            time.sleep(2); continue
+
+        for upd in data.get("result", []):
+            update_offset = upd["update_id"] + 1
+
+            dispatch_update(upd)
+            STORE.set_kv("tg_update_offset", update_offset)
+
 def tg_commands_loop():
+    while True:
+        LEADER.wait_leader()   # in cluster solo il leader riceve gli update Telegram
+        try:
+            tg_setup()
+            if WEBHOOK_URL:
+                run_webhook_server()
+            else:
+                poll_updates()
+        except Exception as e:
+            # es. porta del webhook ancora occupata (leader precedente non ancora uscito)
+            print("[Telegram] tg_commands_loop exception:", e)
+            time.sleep(10)
+
+def tg_setup():
     add_subscriber(ADMIN_CHAT_ID)
-    tg_delete_webhook()
     tg_set_my_description(
         "👋 Benvenuto! Scrivi /start o premi Avvia per avviare il BOT e ricevere gli alert GCN.\n"
         "Di default riceverai i trigger GRB Swift/Fermi. Puoi personalizzare i filtri in qualsiasi momento.",
@@ -906,194 +3776,88 @@ def tg_commands_loop():
         ("impostazioni", "⚙️ Azioni principali"),
     ])
 
-    update_offset = None
-    while True:
-        data = tg_get_updates(update_offset)
-        if not data.get("ok", False):
-            time.sleep(2); continue
-
-        for upd in data.get("result", []):
-            update_offset = upd["update_id"] + 1
-
-            if "callback_query" in upd:
-                cb = upd["callback_query"]
-                cb_id = cb.get("id")
-                from_id = cb.get("from", {}).get("id")
-                data_cb = cb.get("data", "") or ""
-                msg = cb.get("message", {}) or {}
-                chat_id = msg.get("chat", {}).get("id")
-                mid = msg.get("message_id")
-
-                if data_cb.startswith("cmd:") and from_id and chat_id and mid:
-                    cmd = data_cb[4:]
-
-                    if cmd == "/menu":
-                        tg_answer_callback_query(cb_id, "")
-                        tg_edit_message_text(chat_id, mid, MAIN_MENU_TEXT, reply_markup=keyboard_main_menu()); continue
-                    if cmd == "/impostazioni":
-                        tg_answer_callback_query(cb_id, "")
-                        tg_edit_message_text(chat_id, mid, SUBMENU_TEXT, reply_markup=keyboard_submenu()); continue
-                    if cmd == "/testriceviultimagcn":
-                        tg_answer_callback_query(cb_id, "⏳ Recupero ultima GCN Circular…")
-                        latest = fetch_latest_circular()
-                        if latest:
-                            cid, title, url = latest
-                            ra_deg, dec_deg, unc, ra_sex, dec_sex = extract_coords_from_circular(url)
-                            extra = ""
-                            if ra_deg is not None and dec_deg is not None:
-                                extra_lines = [
-                                    "📍 <b>Posizione (J2000)</b>",
-                                    f"• RA: {ra_sex}  ({ra_deg:.5f}°)",
-                                    f"• Dec: {dec_sex} ({dec_deg:.5f}°)"
-                                ]
-                                if unc is not None:
-                                    extra_lines.append(f"• Uncertainty: ±{unc:.2f}\"")
-                                extra = "\n" + "\n".join(extra_lines)
-                            text = f"🧪 <b>Test</b>: ultima GCN Circular\n📝 <b>#{cid}</b> — {title}\n🔗 {url}{extra}"
-                            tg_send_text(chat_id, text)
-                        else:
-                            tg_send_text(chat_id, "ℹ️ Nessuna circular trovata al momento. Riprova tra poco.")
-                        continue
-                    if cmd == "/help":
-                        tg_answer_callback_query(cb_id, "")
-                        tg_edit_message_text(chat_id, mid, HELP_TEXT, reply_markup=keyboard_main_menu()); continue
-                    if cmd == "/contattaautore":
-                        tg_answer_callback_query(cb_id, "")
-                        tg_edit_message_text(chat_id, mid, "👤 Contatta l’autore: @antoninobrosio", reply_markup=keyboard_main_menu()); continue
-                    if cmd == "/attivaricezione":
-                        tg_answer_callback_query(cb_id, "")
-                        add_subscriber(from_id); set_muted(from_id, False)
-                        tg_edit_message_text(chat_id, mid, "✅ Ricezione attivata. Riceverai gli alert secondo i filtri.", reply_markup=keyboard_submenu()); continue
-                    if cmd == "/disattivaricezione":
-                        tg_answer_callback_query(cb_id, "")
-                        add_subscriber(from_id); set_muted(from_id, True)
-                        tg_edit_message_text(chat_id, mid, "🚫 Ricezione disattivata. Usa /attivaricezione per riattivare.", reply_markup=keyboard_submenu()); continue
-                    if cmd in ("/filtri", "/filters"):
-                        tg_answer_callback_query(cb_id, "")
-                        kb = keyboard_filters_inline(get_filters(from_id))
-                        tg_edit_message_text(chat_id, mid, render_filters_text(from_id), reply_markup=kb); continue
-                    if cmd == "/status":
-                        tg_answer_callback_query(cb_id, "")
-                        entry = get_user_entry(from_id); muted = entry.get("muted", False)
-                        text = f"ℹ️ <b>Stato</b>: {'🛑 Sospeso' if muted else '🟢 Attivo'}\n\n" + render_filters_text(from_id)
-                        tg_edit_message_text(chat_id, mid, text, reply_markup=keyboard_submenu()); continue
-
-                    tg_answer_callback_query(cb_id, "")
-                    tg_edit_message_text(chat_id, mid, MAIN_MENU_TEXT, reply_markup=keyboard_main_menu()); continue
-
-                if data_cb.startswith("toggle:") and from_id and chat_id and mid:
-                    key = data_cb.split(":", 1)[1]
-                    f = get_filters(from_id)
-                    if key == "gw":
-                        set_filters(from_id, gw=not f.get("gw", False))
-                    elif key == "swiftfermi":
-                        set_filters(from_id, swiftfermi=not f.get("swiftfermi", True))
-                    elif key == "circulars":
-                        set_filters(from_id, circulars=not f.get("circulars", False))
-                    tg_answer_callback_query(cb_id, "🔄 Filtri aggiornati")
-                    new_text = render_filters_text(from_id)
-                    new_kb = keyboard_filters_inline(get_filters(from_id))
-                    tg_edit_message_text(chat_id, mid, new_text, reply_markup=new_kb)
-                    continue
-
-                tg_answer_callback_query(cb_id, "")
-                continue
-
-            # Messaggi normali
-            msg = upd.get("message") or upd.get("edited_message")
-            if not msg or "text" not in msg:
-                continue
-
-            chat_id = msg["chat"]["id"]
-            text = (msg["text"] or "").strip()
-            parts = text.split()
-            cmd = parts[0].lower() if parts else ""
-
-            if cmd == "/start":
-                add_subscriber(chat_id)
-                set_muted(chat_id, False)
-                tg_send_text(chat_id, WELCOME_TEXT, reply_markup=keyboard_main_menu())
-
-            elif cmd == "/menu":
-                tg_send_text(chat_id, MAIN_MENU_TEXT, reply_markup=keyboard_main_menu())
-
-            elif cmd == "/impostazioni":
-                tg_send_text(chat_id, SUBMENU_TEXT, reply_markup=keyboard_submenu())
-
-            elif cmd == "/testriceviultimagcn":
-                latest = fetch_latest_circular()
-                if latest:
-                    cid, title, url = latest
-                    ra_deg, dec_deg, unc, ra_sex, dec_sex = extract_coords_from_circular(url)
-                    extra = ""
-                    if ra_deg is not None and dec_deg is not None:
-                        extra_lines = [
-                            "📍 <b>Posizione (J2000)</b>",
-                            f"• RA: {ra_sex}  ({ra_deg:.5f}°)",
-                            f"• Dec: {dec_sex} ({dec_deg:.5f}°)"
-                        ]
-                        if unc is not None:
-                            extra_lines.append(f"• Uncertainty: ±{unc:.2f}\"")
-                        extra = "\n" + "\n".join(extra_lines)
-                    text = f"🧪 <b>Test</b>: ultima GCN Circular\n📝 <b>#{cid}</b> — {title}\n🔗 {url}{extra}"
-                    tg_send_text(chat_id, text)
-                else:
-                    tg_send_text(chat_id, "ℹ️ Nessuna circular trovata al momento. Riprova tra poco.")
-
-            elif cmd == "/attivaricezione":
-                add_subscriber(chat_id)
-                set_muted(chat_id, False)
-                tg_send_text(chat_id, "✅ Ricezione attivata. Riceverai gli alert secondo i filtri.", reply_markup=keyboard_submenu())
-
-            elif cmd == "/disattivaricezione":
-                add_subscriber(chat_id)
-                set_muted(chat_id, True)
-                tg_send_text(chat_id, "🚫 Ricezione disattivata. Usa /attivaricezione per riattivare.", reply_markup=keyboard_submenu())
-
-            elif cmd in ("/filtri", "/filters"):
-                add_subscriber(chat_id)
-                kb = keyboard_filters_inline(get_filters(chat_id))
-                tg_send_text(chat_id, render_filters_text(chat_id), reply_markup=kb)
-
-            elif cmd == "/status":
-                entry = get_user_entry(chat_id)
-                muted = entry.get("muted", False)
-                tg_send_text(
-                    chat_id,
-                    f"ℹ️ <b>Stato</b>: {'🛑 Sospeso' if muted else '🟢 Attivo'}\n\n" + render_filters_text(chat_id),
-                    reply_markup=keyboard_submenu()
-                )
-
-            elif cmd == "/help":
-                tg_send_text(chat_id, HELP_TEXT, reply_markup=keyboard_main_menu())
-
-            elif cmd == "/contattaautore":
-                tg_send_text(chat_id, "👤 Contatta l’autore: @antoninobrosio", reply_markup=keyboard_main_menu())
-
-            else:
-                tg_send_text(chat_id, "📂 Usa <b>/menu</b> per il menu principale o <b>/impostazioni</b> per le azioni.", reply_markup=keyboard_main_menu())
-
-        time.sleep(1)
-
 # ==========================
 # MAIN
 # ==========================
-def _acquire_single_instance_lock(port: int = 54673) -> Optional[socket.socket]:
+INSTANCE_LOCK_PORT = 54673   # + indice del worker; il launcher usa la porta precedente
+
+def _acquire_instance_lock(port: int) -> Optional[socket.socket]:
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.bind(("127.0.0.1", port))
         s.listen(1)
         return s
     except OSError:
-        print("[GCN] Un'altra istanza è già in esecuzione (lock TCP occupato).")
+        print(f"[GCN] Un'altra istanza è già in esecuzione (lock TCP {port} occupato).")
         return None
 
+def _workers_arg(argv: List[str]) -> Tuple[int, List[str]]:
+    """Estrae `--workers N` (o `--workers=N`) dagli argomenti; restituisce N e gli argomenti rimasti."""
+    n, rest, i = 0, [], 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--workers" and i + 1 < len(argv):
+            n, i = int(argv[i + 1]), i + 2
+            continue
+        if arg.startswith("--workers="):
+            n = int(arg.split("=", 1)[1])
+        else:
+            rest.append(arg)
+        i += 1
+    return n, rest
+
+def run_cluster(n: int, args: List[str]) -> None:
+    """Launcher: avvia n worker (questo script con GCN_BOT_WORKER=i) e riavvia quelli che terminano."""
+    cmd = [sys.executable] if getattr(sys, "frozen", False) else [sys.executable, os.path.abspath(__file__)]
+
+    def spawn(i: int) -> subprocess.Popen:
+        env = dict(os.environ, GCN_BOT_WORKERS=str(n), GCN_BOT_WORKER=str(i))
+        return subprocess.Popen(cmd + args, env=env)
+
+    # SIGTERM (systemd, docker stop): chiude anche i worker invece di lasciarli orfani
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    procs = [spawn(i) for i in range(n)]
+    print(f"✅ GCN BOT cluster avviato: {n} worker. Dati persistenti in: {DATA_DIR}")
+    try:
+        while True:
+            time.sleep(5)
+            for i, p in enumerate(procs):
+                if p.poll() is not None:
+                    print(f"[Cluster] worker {i} terminato (codice {p.returncode}), lo riavvio")
+                    procs[i] = spawn(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+        print("\nBye.")
+
 if __name__ == "__main__":
-    lock_sock = _acquire_single_instance_lock()
+    multiprocessing.freeze_support()
+    if "--bench-fermi" in sys.argv:
+        bench_fermi_parser()
+        raise SystemExit(0)
+    workers, args = _workers_arg(sys.argv[1:])
+    if workers > 1:
+        lock_sock = _acquire_instance_lock(INSTANCE_LOCK_PORT - 1)
+        if lock_sock is None:
+            raise SystemExit(1)
+        run_cluster(workers, args)
+        raise SystemExit(0)
+    lock_sock = _acquire_instance_lock(INSTANCE_LOCK_PORT + WORKER_INDEX)
     if lock_sock is None:
         raise SystemExit(1)
 
-    print(f"✅ GCN BOT avviato. Dati persistenti in: {DATA_DIR}")
+    if WORKER_COUNT > 1:
+        print(f"✅ GCN BOT worker {WORKER_INDEX}/{WORKER_COUNT} avviato. Dati persistenti in: {DATA_DIR}")
+    else:
+        print(f"✅ GCN BOT avviato. Dati persistenti in: {DATA_DIR}")
+    LEADER.start()
+    SUBSCRIBERS.start()
+    OUTBOX.start()
+    start_pipeline()
     t1 = threading.Thread(target=consumer_loop, daemon=True)
     t1.start()
     t3 = threading.Thread(target=circulars_loop, daemon=True)
@@ -1105,4 +3869,5 @@ if __name__ == "__main__":
         while True:
             time.sleep(3600)
     except KeyboardInterrupt:
+        SUBSCRIBERS.flush()
         print("\nBye.")
@@ -0,0 +1,147 @@
+"""Test del bot: il modulo "GCN BOT.py" viene caricato dal percorso del file.
+
+Senza credenziali compilate (segnaposto nel sorgente) o senza le dipendenze
+il file non si importa e i test vengono saltati.
+"""
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BOT_FILE = Path(os.getenv("GCN_BOT_FILE", Path(__file__).resolve().parent.parent / "GCN BOT.py"))
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    os.environ.setdefault("GCN_BOT_DATA", str(tmp_path_factory.mktemp("data")))
+    spec = importlib.util.spec_from_file_location("gcn_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except (SyntaxError, ImportError) as e:
+        pytest.skip(f"GCN BOT.py non importabile: {e}")
+    sys.modules["gcn_bot"] = module
+    return module
+
+
+def _fermi(key, t, ra=10.0, dec=10.0, err=3.0, rank=1):
+    return {"ra": ra, "dec": dec, "source": "fermi", "event_time": t, "error_deg": err,
+            "event_key": key, "event_rank": rank}
+
+
+def test_same_instrument_triggers_stay_separate(bot):
+    index = bot.EventIndex()
+    index.correlate("trigger 1", _fermi("fermi:1", 1000.0, rank=2))
+    out = index.correlate("trigger 2", _fermi("fermi:2", 1010.0, ra=10.5, rank=1))
+    assert out is not None
+    assert out[0] == "trigger 2"
+    assert out[1]["event_key"] == "fermi:2"
+    assert index.merged == 0
+
+
+def test_other_instrument_joins_by_position(bot):
+    index = bot.EventIndex()
+    index.correlate("fermi", _fermi("fermi:1", 1000.0))
+    swift = {"ra": 10.2, "dec": 10.0, "source": "swift", "event_time": 1030.0, "error_deg": 0.05,
+             "event_key": "swift:9"}
+    caption, meta = index.correlate("swift", swift)
+    assert meta["event_key"] == "fermi:1"
+    assert "Evento correlato" in caption
+    assert index.merged == 1
+
+
+def test_offset_of_revoked_partition_is_ignored(bot):
+    tracker = bot.OffsetTracker()
+    old = tracker.track("t", 0, 5)
+    tracker.forget([("t", 0)])
+    new = tracker.track("t", 0, 5)
+    old.done()
+    assert tracker.committable() == [("t", 0, 5)]
+    new.done()
+    assert tracker.committable() == [("t", 0, 6)]
+
+
+def test_failed_stage_keeps_offset_until_dead_letter(bot, monkeypatch):
+    monkeypatch.setattr(bot, "STAGE_RETRY_BASE", 0.01)
+    calls = []
+
+    def handler(item):
+        calls.append(item)
+        raise RuntimeError("database is locked")
+
+    tracker = bot.OffsetTracker()
+    token = tracker.track("t", 0, 7, b"raw")
+    stage = bot.Stage("test", handler, dead_letter=bot.dead_letter_item)
+    stage.start()
+    stage.put(("caption", {}, token))
+    deadline = bot.time.monotonic() + 5
+    while tracker.pending() and bot.time.monotonic() < deadline:
+        assert tracker.committable() == [("t", 0, 7)]
+        bot.time.sleep(0.01)
+    assert len(calls) == bot.STAGE_MAX_ATTEMPTS
+    assert tracker.committable() == [("t", 0, 8)]
+    row = bot.STORE._db().execute('SELECT topic, "offset", stage, value FROM dead_letters').fetchone()
+    assert row == ("t", 7, "test", b"raw")
+
+
+def test_offsets_marked_only_on_successful_commit(bot):
+    tp = bot.TopicPartition("t", 0, 3)
+    bot.OFFSETS.track("t", 0, 2).done()
+    assert ("t", 0, 3) in bot.OFFSETS.committable()
+    bot._on_commit(RuntimeError("broker down"), [tp])
+    assert ("t", 0, 3) in bot.OFFSETS.committable()
+    bot._on_commit(None, [tp])
+    assert ("t", 0, 3) not in bot.OFFSETS.committable()
+
+
+def _moc_fits_bytes():
+    """Skymap multi-order minima: 12 pixel di ordine 0, probabilità concentrata nel primo."""
+    np = pytest.importorskip("numpy")
+    fits = pytest.importorskip("astropy.io.fits")
+    import io
+    uniq = np.arange(4, 16, dtype=np.int64)
+    area = 4 * np.pi / 12
+    dens = np.full(12, 1e-6 / area)
+    dens[0] = (1 - 11e-6) / area
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name="UNIQ", format="K", array=uniq),
+        fits.Column(name="PROBDENSITY", format="D", array=dens, unit="sr-1"),
+    ])
+    hdu.header["ORDERING"] = "NUNIQ"
+    buf = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buf)
+    return buf.getvalue()
+
+
+def test_igwn_alert_embedded_skymap(bot, monkeypatch):
+    import base64
+    import json
+    if not bot.HAVE_HEALPY:
+        pytest.skip("healpy non installato")
+    # i processi del pool non possono importare un modulo caricato da percorso
+    monkeypatch.setattr(bot, "render", bot.render_job)
+    raw = _moc_fits_bytes()
+    payload = {
+        "alert_type": "UPDATE",
+        "superevent_id": "S261017a",
+        "time_created": "2026-10-17T10:00:00Z",
+        "event": {
+            "time": "2026-10-17T09:59:00Z",
+            "far": 1e-10,
+            "classification": {"BNS": 0.9, "Terrestrial": 0.1},
+            "skymap": base64.b64encode(raw).decode(),
+        },
+        "external_coinc": None,
+    }
+    caption, meta = bot.parse_message("igwn.gwalert", json.dumps(payload).encode())
+    assert caption and "S261017a" in caption
+    path, key = bot.alert_skymap_file(meta)
+    assert path.read_bytes() == raw
+    pix = bot.alert_skymap_region(meta)
+    assert pix is not None and len(pix) > 0
+    # regione nel primo pixel di ordine 0 (NESTED 0 → RING), nessun punto nel pixel opposto
+    hp = pytest.importorskip("healpy")
+    theta, phi = hp.pix2ang(bot.SKY_INDEX_NSIDE, pix)
+    assert set(hp.ang2pix(1, theta, phi, nest=True).tolist()) == {0}